@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Microbenchmark for response decoding (vkontakte.api._json_iterparse).
+
+Compares the current implementation with every available JSON backend
+against the original "decode everything and raw_decode in a loop"
+implementation on wall.get-like payloads of different sizes::
+
+    $ python benchmarks/bench_decode.py
+"""
+from __future__ import print_function
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from vkontakte import api
+
+
+def legacy_iterparse(response):
+    response = response.strip().decode('utf8', 'ignore')
+    decoder = json.JSONDecoder(strict=False)
+    idx = 0
+    while idx < len(response):
+        obj, idx = decoder.raw_decode(response, idx)
+        yield obj
+
+
+def make_payload(posts):
+    items = [{
+        'id': i, 'from_id': -1, 'owner_id': -1, 'date': 1386616969 + i,
+        'text': u'Текст записи номер %d, немного текста для объема. ' % i * 3,
+        'likes': {'count': i % 100, 'user_likes': 0},
+        'attachments': [{'type': 'photo', 'photo': {'id': i, 'sizes': [1, 2, 3]}}],
+    } for i in range(posts)]
+    return json.dumps({'response': {'count': posts, 'items': items}},
+                      ensure_ascii=False).encode('utf8')
+
+
+def bench(func, payload, number):
+    return min(timeit.repeat(lambda: list(func(payload)), number=number, repeat=7)) / number
+
+
+def main():
+    backends = []
+    for name in sorted(api.JSON_BACKENDS):
+        try:
+            api.set_json_backend(name)
+        except ImportError:
+            continue
+        backends.append(name)
+
+    print('%-10s %10s %12s %s' % ('posts', 'size, KB', 'legacy, ms',
+                                  ' '.join('%12s' % ('%s, ms' % name) for name in backends)))
+    for posts in (10, 1000, 20000):
+        payload = make_payload(posts)
+        number = max(1, 2000 // posts)
+        legacy = bench(legacy_iterparse, payload, number)
+        timings = []
+        for name in backends:
+            api.set_json_backend(name)
+            timings.append(bench(api._json_iterparse, payload, number))
+        print('%-10d %10d %12.3f %s' % (
+            posts, len(payload) // 1024, legacy * 1000,
+            ' '.join('%12s' % ('%.3f (x%.1f)' % (t * 1000, legacy / t)) for t in timings)))
+    api.set_json_backend('json')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for api.vk.com used by benchmarks.
+
+Serves ``/method/<name>`` (token requests) and ``/api.php`` (signed
+requests) over keep-alive HTTP/1.1, optionally over TLS::
+
+    >>> server = FakeVKServer(latency=0.01, items=100, error6_rate=0.1)
+    >>> server.start()
+    >>> server.patch_api()  # point vkontakte.api at the server
+    >>> ...
+    >>> server.stop()
+
+Responses are wall.get-like ``{"response": {"count": N, "items": [...]}}``
+objects; ``error6_rate`` of requests fail with "Too many requests per
+second" error and with ``concat_errors`` enabled responses are preceded
+by an error object the way vk.com sometimes does.
+"""
+from __future__ import with_statement
+import json
+import random
+import ssl
+import threading
+import time
+
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.urllib.parse import parse_qsl, urlsplit
+
+from vkontakte import api
+
+ERROR_6 = {'error': {'error_code': 6, 'error_msg': 'Too many requests per second',
+                     'request_params': []}}
+ERROR_8 = {'error': {'error_code': 8, 'error_msg': 'Invalid request', 'request_params': []}}
+
+
+def make_response(items):
+    return {'response': {'count': items, 'items': [{
+        'id': i, 'from_id': -1, 'owner_id': -1, 'date': 1386616969 + i,
+        'text': u'Текст записи номер %d' % i,
+        'likes': {'count': i % 100, 'user_likes': 0},
+    } for i in range(items)]}}
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        server = self.server
+        params = dict(parse_qsl(self.rfile.read(int(self.headers['Content-Length'])).decode('ascii')))
+        # vkontakte.http sends absolute URLs as request targets
+        path = urlsplit(self.path).path
+        if path.startswith('/method/'):
+            method = path[len('/method/'):]
+        elif path == '/api.php':
+            method = params.get('method')
+        else:
+            self.send_error(404)
+            return
+        with server.lock:
+            server.requests += 1
+            server.methods[method] = server.methods.get(method, 0) + 1
+
+        if server.latency:
+            time.sleep(server.latency)
+        if server.error6_rate and random.random() < server.error6_rate:
+            body = server.error6_body
+        else:
+            body = server.body
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeVKServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    # many clients connect at once in concurrent benchmarks
+    request_queue_size = 128
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0, items=10, error6_rate=0,
+                 concat_errors=False, certfile=None, keyfile=None):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), _Handler)
+        self.latency = latency
+        self.error6_rate = error6_rate
+        self.secure = certfile is not None
+        if self.secure:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(certfile, keyfile)
+            self.socket = context.wrap_socket(self.socket, server_side=True)
+
+        prefix = json.dumps(ERROR_8) if concat_errors else ''
+        self.body = (prefix + json.dumps(make_response(items), ensure_ascii=False)).encode('utf8')
+        self.error6_body = json.dumps(ERROR_6).encode('utf8')
+
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.methods = {}
+        self._thread = None
+        self._patched = None
+
+    @property
+    def url(self):
+        return '%s://%s:%d' % ('https' if self.secure else 'http',
+                               self.server_address[0], self.server_address[1])
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.unpatch_api()
+        self.shutdown()
+        self.server_close()
+
+    def patch_api(self):
+        """ Send requests of vkontakte.api to this server. """
+        self._patched = api.API_URL, api.SECURE_API_URL
+        api.API_URL = self.url + '/api.php'
+        api.SECURE_API_URL = self.url + '/method/'
+
+    def unpatch_api(self):
+        if self._patched is not None:
+            api.API_URL, api.SECURE_API_URL = self._patched
+            self._patched = None
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for vkontakte client against a local fake vk.com server.
+
+Measures throughput and p50/p99 latency of API calls made sequentially,
+from a pool of threads and from asyncio tasks, as well as time and
+memory allocated per call of the hot path functions (method dispatch, signature,
+_encode, _prepare_request, PreparedCall, _request, _json_iterparse)::
+
+    $ python benchmarks/run.py --requests 2000 --latency 0.005 --json new.json
+    $ python benchmarks/run.py --requests 2000 --latency 0.005 --compare new.json
+
+With ``--compare`` the results are compared with a previously saved run
+and the exit code is 1 if any metric is worse by more than ``--threshold``.
+"""
+from __future__ import print_function
+import argparse
+import json
+import os
+import ssl
+import sys
+import threading
+import time
+import timeit
+import tracemalloc
+import warnings
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import vkontakte
+from vkontakte import api, http
+
+from fakeserver import FakeVKServer
+
+# metrics where bigger values are better; for the rest smaller is better
+HIGHER_IS_BETTER = ('rps',)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def summarize(latencies, elapsed):
+    return {
+        'rps': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+    }
+
+
+def timed_call(vk, latencies, errors):
+    start = time.time()
+    try:
+        vk.wall.get(owner_id=1, count=10)
+    except vkontakte.VKError:
+        errors.append(1)
+    latencies.append(time.time() - start)
+
+
+def bench_sync(vk, requests, concurrency):
+    latencies, errors = [], []
+    start = time.time()
+    for i in range(requests):
+        timed_call(vk, latencies, errors)
+    return summarize(latencies, time.time() - start), len(errors)
+
+
+def bench_threaded(vk, requests, concurrency):
+    latencies, errors = [], []
+    per_thread = requests // concurrency
+
+    def worker():
+        for i in range(per_thread):
+            timed_call(vk, latencies, errors)
+
+    threads = [threading.Thread(target=worker) for i in range(concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(latencies, time.time() - start), len(errors)
+
+
+def bench_async(vk_args, requests, concurrency, insecure):
+    import asyncio
+
+    latencies, errors = [], []
+
+    async def worker(vk, count):
+        for i in range(count):
+            start = time.time()
+            try:
+                await vk.wall.get(owner_id=1, count=10)
+            except vkontakte.VKError:
+                errors.append(1)
+            latencies.append(time.time() - start)
+
+    async def main():
+        pool = vkontakte.AsyncConnectionPool(maxsize=concurrency, concurrency=concurrency)
+        if insecure:
+            pool._ssl_context = ssl._create_unverified_context()
+        async with vkontakte.AsyncAPI(pool=pool, **vk_args) as vk:
+            start = time.time()
+            await asyncio.gather(*[worker(vk, requests // concurrency) for i in range(concurrency)])
+            return time.time() - start
+
+    loop = asyncio.new_event_loop()
+    try:
+        elapsed = loop.run_until_complete(main())
+    finally:
+        loop.close()
+    return summarize(latencies, elapsed), len(errors)
+
+
+def micro(func, number):
+    """ Return (microseconds, allocated bytes) per call of ``func``. """
+    func()  # warm up
+    seconds = min(timeit.repeat(func, number=number, repeat=5)) / number
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        func()
+        allocated = tracemalloc.get_traced_memory()[1] - before
+    finally:
+        tracemalloc.stop()
+    return {'us': seconds * 1e6, 'alloc_bytes': allocated}
+
+
+class _DispatchAPI(vkontakte.API):
+    """ API without requests: measures vk.<namespace>.<method>() overhead. """
+
+    def _get(self, method, timeout=api.DEFAULT_TIMEOUT, **kwargs):
+        return None
+
+
+def bench_micro(vk, server_body):
+    params = {'owner_id': 1, 'count': 10, 'filter': 'owner', 'fields': ['sex', 'bdate'],
+              'api_id': '1', 'method': 'wall.get', 'format': 'JSON', 'v': '3.0',
+              'random': 12345, 'timestamp': 1386616969}
+    signed = vkontakte.API('1', 'secret', v='5.0')
+    dispatch = _DispatchAPI(token='token', v='5.0')
+    results = {
+        'dispatch': micro(lambda: dispatch.friends.get(user_id=1), 20000),
+        '_prepare_request': micro(lambda: signed._prepare_request(
+            'users.get', fields=['sex', 'bdate', 'city'], name_case='gen', v='5.0', user_ids=1), 2000),
+        'signature': micro(lambda: api.signature('secret', params), 2000),
+        '_encode': micro(lambda: api._encode({'type': '1', 'id': 1}), 20000),
+        '_request': micro(lambda: vk._request('wall.get', owner_id=1, count=10), 200),
+        '_json_iterparse': micro(lambda: list(api._json_iterparse(server_body)), 200),
+    }
+    # prepared calls don't exist in older revisions (instances answer
+    # any attribute with a method proxy, so the class is checked)
+    if hasattr(vkontakte.API, 'prepare'):
+        prepared = signed.prepare('users.get', fields=['sex', 'bdate', 'city'], name_case='gen')
+        results['prepared'] = micro(lambda: prepared._prepare_request(
+            dict(prepared.params, user_ids=1)), 2000)
+    return results
+
+
+def flatten(results):
+    flat = {}
+    for group, metrics in results.items():
+        for name, value in metrics.items():
+            flat['%s.%s' % (group, name)] = value
+    return flat
+
+
+def compare(results, baseline_path, threshold):
+    with open(baseline_path) as f:
+        baseline = flatten(json.load(f))
+    regressions = 0
+    print('\n%-32s %12s %12s %8s' % ('metric', 'baseline', 'current', 'change'))
+    for name, value in sorted(flatten(results).items()):
+        if name not in baseline or not baseline[name]:
+            continue
+        change = (value - baseline[name]) / float(baseline[name])
+        worse = -change if name.endswith(HIGHER_IS_BETTER) else change
+        mark = ''
+        if worse > threshold:
+            mark = '  REGRESSION'
+            regressions += 1
+        print('%-32s %12.2f %12.2f %+7.1f%%%s' % (name, baseline[name], value, change * 100, mark))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--modes', default='sync,threaded,async')
+    parser.add_argument('--auth', choices=['token', 'sig'], default='token',
+                        help="token requests (/method/<name>) or signed ones (api.php)")
+    parser.add_argument('--latency', type=float, default=0, help="server latency, seconds")
+    parser.add_argument('--items', type=int, default=10, help="items in every response")
+    parser.add_argument('--error6-rate', type=float, default=0)
+    parser.add_argument('--concat-errors', action='store_true',
+                        help="prepend an error object to every response")
+    parser.add_argument('--certfile', help="serve over TLS using this certificate")
+    parser.add_argument('--keyfile')
+    parser.add_argument('--json', help="save results to this file")
+    parser.add_argument('--compare', help="compare results with this file")
+    parser.add_argument('--threshold', type=float, default=0.1)
+    args = parser.parse_args()
+
+    server = FakeVKServer(latency=args.latency, items=args.items, error6_rate=args.error6_rate,
+                          concat_errors=args.concat_errors,
+                          certfile=args.certfile, keyfile=args.keyfile).start()
+    server.patch_api()
+    if args.concat_errors:
+        # errors followed by a response are reported as warnings
+        warnings.simplefilter('ignore')
+    if args.certfile:
+        # the fake server uses a self-signed certificate
+        ssl._create_default_https_context = ssl._create_unverified_context
+
+    vk_args = {'token': 'token'} if args.auth == 'token' else {'api_id': '1', 'api_secret': 'secret'}
+    vk_args['timeout'] = 10
+    results = {}
+    try:
+        for mode in args.modes.split(','):
+            http.default_pool.clear()
+            if mode == 'async':
+                stats, errors = bench_async(vk_args, args.requests, args.concurrency, bool(args.certfile))
+            else:
+                bench = bench_sync if mode == 'sync' else bench_threaded
+                stats, errors = bench(vkontakte.API(**vk_args), args.requests, args.concurrency)
+            results[mode] = stats
+            print('%-10s %8.0f req/s  p50 %7.2f ms  p99 %7.2f ms  errors %d' % (
+                mode, stats['rps'], stats['p50_ms'], stats['p99_ms'], errors))
+
+        print()
+        for name, stats in sorted(bench_micro(vkontakte.API(**vk_args), server.body).items()):
+            results[name] = stats
+            print('%-16s %10.2f us/call %10d bytes/call' % (name, stats['us'], stats['alloc_bytes']))
+    finally:
+        server.stop()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        return 1 if compare(results, args.compare, args.threshold) else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
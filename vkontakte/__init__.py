@@ -1 +1,12 @@
-from vkontakte.api import API, VKError, signature
+import sys
+
+from vkontakte.api import API, VKError, HTTPError, signature
+from vkontakte.cache import ResponseCache
+from vkontakte.http import ConnectionPool
+from vkontakte.instrumentation import Instrumentation, MetricsAggregator
+from vkontakte.ratelimit import RateLimiter
+from vkontakte.retry import RetryPolicy, CircuitBreaker, CircuitOpenError
+from vkontakte.tokens import TokenPool
+
+if sys.version_info >= (3, 5):
+    from vkontakte.aio import AsyncAPI, AsyncConnectionPool
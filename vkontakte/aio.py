@@ -0,0 +1,265 @@
+# coding: utf-8
+"""
+asyncio-based client for vk.com API (python 3.5+).
+
+    >>> vk = AsyncAPI(token='my_access_token')
+    >>> await vk.getServerTime()
+    >>> await vk.friends.get(uid=642177)
+    >>> await vk.get('getServerTime')
+"""
+import asyncio
+import socket
+import ssl
+import time
+
+from vkontakte.api import _API, DEFAULT_TIMEOUT
+from vkontakte.http import DEFAULT_POOL_SIZE, DEFAULT_IDLE_TIMEOUT
+
+DEFAULT_CONCURRENCY = 100
+
+
+class _Connection(object):
+    __slots__ = ['reader', 'writer', 'last_used']
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.last_used = time.time()
+
+    def close(self):
+        self.writer.close()
+
+    def is_dropped(self):
+        """ Check if the server has closed the idle connection. """
+        return self.reader.at_eof() or self.writer.transport.is_closing()
+
+    def abort(self):
+        """ Close connection whose event loop is already closed. """
+        try:
+            self.writer.close()
+        except RuntimeError:
+            sock = self.writer.get_extra_info('socket')
+            if sock is not None:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    async def aclose(self):
+        self.writer.close()
+        if hasattr(self.writer, 'wait_closed'):  # python 3.7+
+            try:
+                await self.writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+
+
+async def _read_response(reader, status_line):
+    version, status = status_line.decode('latin-1').split(None, 2)[:2]
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    keep_alive = (version == 'HTTP/1.1' and
+                  headers.get('connection', '').lower() != 'close')
+
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        chunks = []
+        while True:
+            line = await reader.readline()
+            if not line:
+                raise ConnectionResetError("Connection closed while reading response")
+            size = int(line.split(b';')[0], 16)
+            if not size:
+                # skip trailers
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+        body = b''.join(chunks)
+    elif 'content-length' in headers:
+        body = await reader.readexactly(int(headers['content-length']))
+    else:
+        body = await reader.read()
+        keep_alive = False
+
+    return int(status), body, keep_alive
+
+
+async def _send(connection, request, stale_ok=False):
+    """
+    Send the request and return (status, body, keep_alive) tuple.
+
+    If ``stale_ok`` is True and writing the request fails, None is
+    returned and the request can be safely resent (see vkontakte.http._send).
+    """
+    try:
+        connection.writer.write(request)
+        await connection.writer.drain()
+    except ConnectionError:
+        if stale_ok:
+            return None
+        raise
+
+    status_line = await connection.reader.readline()
+    if not status_line:
+        raise ConnectionResetError("Remote end closed connection without response")
+    return await _read_response(connection.reader, status_line)
+
+
+class AsyncConnectionPool(object):
+    """
+    Non-blocking counterpart of :class:`vkontakte.http.ConnectionPool`.
+
+    Keeps idle keep-alive connections per host and limits the number of
+    requests in flight to ``concurrency``. Connections are bound to the
+    event loop they were made in, so the pool is reset when it is used
+    from another loop.
+    """
+
+    def __init__(self, maxsize=DEFAULT_POOL_SIZE, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 concurrency=DEFAULT_CONCURRENCY):
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.concurrency = concurrency
+        self._idle = {}
+        self._loop = None
+        self._semaphore = None
+        self._ssl_context = None
+
+    def _bind(self):
+        loop = asyncio.get_event_loop()
+        if loop is not self._loop:
+            # transports of the previous loop can't be used (or even
+            # closed properly) anymore
+            for connections in self._idle.values():
+                for connection in connections:
+                    connection.abort()
+            self._idle = {}
+            self._loop = loop
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+
+    def _acquire(self, key):
+        now = time.time()
+        idle = self._idle.get(key)
+        while idle:
+            connection = idle.pop()
+            if now - connection.last_used < self.idle_timeout and not connection.is_dropped():
+                return connection
+            connection.close()
+        return None
+
+    def _release(self, key, connection):
+        connection.last_used = time.time()
+        idle = self._idle.setdefault(key, [])
+        if len(idle) < self.maxsize:
+            idle.append(connection)
+        else:
+            connection.close()
+
+    async def _connect(self, host_port, secure):
+        host, _, port = host_port.partition(':')
+        port = int(port) if port else (443 if secure else 80)
+        context = None
+        if secure:
+            if self._ssl_context is None:
+                self._ssl_context = ssl.create_default_context()
+            context = self._ssl_context
+        reader, writer = await asyncio.open_connection(host, port, ssl=context)
+        return _Connection(reader, writer)
+
+    async def _post(self, url, data, headers, secure):
+        host_port, path = url.split('/', 3)[2:]
+        key = (secure, host_port)
+
+        if not isinstance(data, bytes):
+            data = data.encode('ascii')
+        lines = ['POST /%s HTTP/1.1' % path, 'Host: %s' % host_port,
+                 'Content-Length: %d' % len(data), 'Connection: keep-alive']
+        lines.extend('%s: %s' % item for item in headers.items())
+        request = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + data
+
+        connection = self._acquire(key)
+        result = None
+        if connection is not None:
+            try:
+                result = await _send(connection, request, stale_ok=True)
+            except BaseException:
+                connection.close()
+                raise
+            if result is None:
+                # the server has dropped the idle connection before
+                # the request was written; send it using a fresh one
+                await connection.aclose()
+
+        if result is None:
+            connection = await self._connect(host_port, secure)
+            try:
+                result = await _send(connection, request)
+            except BaseException:
+                connection.close()
+                raise
+
+        status, body, keep_alive = result
+        if keep_alive:
+            self._release(key, connection)
+        else:
+            await connection.aclose()
+        return status, body
+
+    async def post(self, url, data, headers, timeout, secure=False):
+        self._bind()
+        async with self._semaphore:
+            return await asyncio.wait_for(self._post(url, data, headers, secure), timeout)
+
+    async def clear(self):
+        """ Close all idle connections. """
+        self._bind()
+        idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                await connection.aclose()
+
+
+# options of vkontakte.API that asynchronous calls don't go through
+UNSUPPORTED_OPTIONS = ('rate_limiter', 'cache', 'token_pool', 'instrumentation', 'retry')
+
+
+class _AsyncAPI(_API):
+
+    def __init__(self, api_id=None, api_secret=None, token=None, pool=None, **defaults):
+        for option in UNSUPPORTED_OPTIONS:
+            if option in defaults:
+                raise TypeError("AsyncAPI doesn't support '%s' argument" % option)
+        if pool is None:
+            pool = AsyncConnectionPool()
+        super(_AsyncAPI, self).__init__(api_id, api_secret, token, pool, **defaults)
+
+    async def _get(self, method, timeout=DEFAULT_TIMEOUT, **kwargs):
+        status, response = await self._request(method, timeout=timeout, **kwargs)
+        return self._handle_response(status, response, kwargs)["response"]
+
+    def _request(self, method, timeout=DEFAULT_TIMEOUT, **kwargs):
+        url, data, headers, secure = self._prepare_request(method, **kwargs)
+        return self.pool.post(url, data, headers, timeout, secure=secure)
+
+
+class AsyncAPI(_AsyncAPI):
+
+    def get(self, method, timeout=DEFAULT_TIMEOUT, **kwargs):
+        return self._get(method, timeout, **kwargs)
+
+    async def close(self):
+        await self.pool.clear()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
@@ -2,6 +2,7 @@
 import random
 import time
 import warnings
+from bisect import insort
 from functools import partial
 from hashlib import md5
 import json
@@ -17,6 +18,12 @@ SECURE_API_URL = 'https://api.vk.com/method/'
 DEFAULT_TIMEOUT = 1
 REQUEST_ENCODING = 'utf8'
 
+REQUEST_HEADERS = {"Accept": "application/json",
+                   "Content-Type": "application/x-www-form-urlencoded"}
+
+# vk.com allows up to 25 API calls in one "execute" request
+MAX_BATCH_SIZE = 25
+
 
 # See full list of VK API methods here:
 # http://vk.com/developers.php?o=-1&p=%D0%A0%D0%B0%D1%81%D1%88%D0%B8%D1%80%D0%B5%D0%BD%D0%BD%D1%8B%D0%B5_%D0%BC%D0%B5%D1%82%D0%BE%D0%B4%D1%8B_API&s=0
@@ -55,6 +62,11 @@ class VKError(Exception):
         return "Error(code = '%s', description = '%s', params = '%s')" % (self.code, self.description, self.params)
 
 
+class HTTPError(VKError):
+    """ Non-2xx HTTP response; ``code`` is the HTTP status. """
+    __slots__ = []
+
+
 def _encode(s):
     if isinstance(s, (dict, list, tuple)):
         s = json.dumps(s, ensure_ascii=False)
@@ -68,12 +80,73 @@ def _encode(s):
     return s  # this can be number, etc.
 
 
+_json_decoder = json.JSONDecoder(strict=False)
+
+
+def _stdlib_json_loads(data):
+    return _json_decoder.decode(data.decode('utf8'))
+
+
+def _orjson_loads(data):
+    import orjson
+    return orjson.loads(data)
+
+
+def _ujson_loads(data):
+    import ujson
+    return ujson.loads(data)
+
+
+JSON_BACKENDS = {
+    'json': _stdlib_json_loads,
+    'orjson': _orjson_loads,
+    'ujson': _ujson_loads,
+}
+
+_json_loads = _stdlib_json_loads
+
+
+def set_json_backend(name):
+    """
+    Select function used for decoding responses: 'json' (standard
+    library, the default), 'orjson', 'ujson' or 'auto' (the fastest one
+    installed). Responses that the selected backend can't decode (e.g.
+    concatenated objects or strings with control characters) are
+    decoded with the standard library anyway.
+    """
+    global _json_loads
+    if name != 'auto' and name not in JSON_BACKENDS:
+        raise ValueError("Unknown JSON backend: %s" % name)
+    if name == 'auto':
+        for name in ('orjson', 'ujson', 'json'):
+            try:
+                __import__(name)
+                break
+            except ImportError:
+                pass
+    elif name != 'json':
+        __import__(name)  # raise ImportError early
+    _json_loads = JSON_BACKENDS[name]
+
+
 def _json_iterparse(response):
+    # fast path: almost every response is a single JSON object
+    # which can be decoded from bytes without extra copies
+    try:
+        obj = _json_loads(response)
+    except ValueError:
+        pass
+    else:
+        if isinstance(obj, dict):
+            yield obj
+            return
+
+    # slow path: vk.com may return several concatenated objects
+    # (e.g. errors followed by the response) or invalid utf8
     response = response.strip().decode('utf8', 'ignore')
-    decoder = json.JSONDecoder(strict=False)
     idx = 0
     while idx < len(response):
-        obj, idx = decoder.raw_decode(response, idx)
+        obj, idx = _json_decoder.raw_decode(response, idx)
         yield obj
 
 
@@ -88,26 +161,143 @@ def signature(api_secret, params):
 # >>> vk.get('getServerTime')  # "get" is a method of API class
 # >>> vk.friends.get(uid=123)  # "get" is a part of vkontakte method name
 #
-# It works this way: API class has 'get' method but _API class doesn't.
+# It works this way: API class has 'get' method but _Namespace class doesn't.
+# Namespace and method proxies are created on first access and stored
+# as instance attributes, so next lookups don't reach __getattr__ at all.
+
+
+class _Method(object):
+    """ Callable proxy for API method. """
+    __slots__ = ['api', 'method']
+
+    def __init__(self, api, method):
+        self.api = api
+        self.method = method
+
+    def __call__(self, **kwargs):
+        defaults = self.api.defaults
+        if defaults:
+            for key in defaults:
+                if key not in kwargs:
+                    kwargs[key] = defaults[key]
+        return self.api._get(self.method, **kwargs)
+
+
+class _Namespace(object):
+    """ Proxy for api.<namespace> (see COMPLEX_METHODS). """
+    # __dict__ holds cached method proxies
+    __slots__ = ['api', 'method_prefix', '__dict__']
+
+    def __init__(self, api, name):
+        self.api = api
+        self.method_prefix = name + '.'
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        # setdefault: concurrent lookups get the same proxy
+        return self.__dict__.setdefault(name, _Method(self.api, self.method_prefix + name))
+
+    def __call__(self, **kwargs):
+        method = kwargs.pop('method')
+        return getattr(self, method)(**kwargs)
 
 
 class _API(object):
 
-    def __init__(self, api_id=None, api_secret=None, token=None, **defaults):
+    def __init__(self, api_id=None, api_secret=None, token=None, pool=None,
+                 rate_limiter=None, cache=None, token_pool=None, instrumentation=None,
+                 retry=None, **defaults):
 
-        if not (api_id and api_secret or token):
-            raise ValueError("Arguments api_id and api_secret or token are required")
+        if not (api_id and api_secret or token or token_pool):
+            raise ValueError("Arguments api_id and api_secret, token or token_pool are required")
 
         self.api_id = api_id
         self.api_secret = api_secret
         self.token = token
+        self.pool = pool
+        self.rate_limiter = rate_limiter
+        self.cache = cache
+        self.token_pool = token_pool
+        self.instrumentation = instrumentation
+        self.retry = retry
         self.defaults = defaults
         self.method_prefix = ''
 
-    def _get(self, method, timeout=DEFAULT_TIMEOUT, **kwargs):
-        status, response = self._request(method, timeout=timeout, **kwargs)
+    def _get(self, method, timeout=DEFAULT_TIMEOUT, idempotent=None, **kwargs):
+        return self._call(method, timeout, kwargs, idempotent=idempotent)["response"]
+
+    def _call(self, method, timeout, kwargs, prepared=None, idempotent=None):
+        """
+        Call API method and return the whole decoded response object
+        (it may have e.g. "execute_errors" besides "response").
+        Request is built by ``prepared`` (a :class:`PreparedCall`) if given;
+        ``idempotent`` overrides the retry policy's guess for the method.
+        """
+        if (self.rate_limiter is None and self.cache is None and self.token_pool is None
+                and self.instrumentation is None and self.retry is None):
+            return self._fetch(method, timeout, kwargs, prepared)
+
+        trace = None
+        if self.instrumentation is not None:
+            trace = self.instrumentation.start(method, kwargs)
+
+        fetch = partial(self._attempt, method, kwargs, prepared, trace)
+        if self.retry is not None:
+            fetch = partial(self.retry.call, method, timeout, fetch, idempotent,
+                            self.rate_limiter is not None)
+        else:
+            fetch = partial(fetch, timeout)
+        if self.cache is not None and method in self.cache.methods:
+            fetch = partial(self.cache.call, self, method, kwargs, fetch)
+
+        if trace is None:
+            return fetch()
+        return self.instrumentation.call(trace, fetch)
+
+    def _attempt(self, method, kwargs, prepared, trace, timeout):
+        if self.token_pool is not None:
+            return self.token_pool.call(self._pooled_fetch, method, timeout, kwargs, prepared, trace)
+        fetch = partial(self._fetch, method, timeout, kwargs, prepared, trace=trace)
+        if self.rate_limiter is not None:
+            return self.rate_limiter.call(self.token or self.api_id, fetch)
+        return fetch()
+
+    def _pooled_fetch(self, token, method, timeout, kwargs, prepared, trace=None):
+        # rate limits are per token; "Too many requests per second" errors
+        # are not retried by the limiter: the pool switches to another token
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(token)
+        return self._fetch(method, timeout, kwargs, prepared, token, trace)
+
+    def _fetch(self, method, timeout, kwargs, prepared=None, token=None, trace=None):
+        # token from the pool is not a part of request_params of errors
+        request_kwargs = kwargs if token is None else dict(kwargs, access_token=token)
+        if trace is not None:
+            trace.attempts += 1
+            trace.mark()
+        if prepared is None:
+            url, data, headers, secure = self._prepare_request(method, **request_kwargs)
+        else:
+            url, data, headers, secure = prepared._prepare_request(request_kwargs)
+
+        if trace is None:
+            # custom pools may not accept "trace" argument
+            status, response = http.post(url, data, headers, timeout, secure=secure, pool=self.pool)
+            return self._handle_response(status, response, kwargs)
+
+        trace.lap('encode')
+        status, response = http.post(url, data, headers, timeout, secure=secure,
+                                     pool=self.pool, trace=trace)
+        trace.mark()
+        try:
+            return self._handle_response(status, response, kwargs)
+        finally:
+            trace.lap('parse')
+
+    def _handle_response(self, status, response, kwargs):
         if not (200 <= status <= 299):
-            raise VKError({
+            raise HTTPError({
                 'error_code': status,
                 'error_msg': "HTTP error",
                 'request_params': kwargs,
@@ -121,37 +311,54 @@ class _API(object):
             if "response" in data:
                 for error in errors:
                     warnings.warn("%s" % error)
-                return data["response"]
+                return data
 
         raise VKError(errors[0])
 
     def __getattr__(self, name):
         """
-        Support for api.<method>.<methodName> syntax
+        Support for api.<method> and api.<method>.<methodName> syntax
         """
-        if name in COMPLEX_METHODS:
-            api = _API(api_id=self.api_id, api_secret=self.api_secret, token=self.token, **self.defaults)
-            api.method_prefix = name + '.'
-            return api
+        if name.startswith('__'):
+            # special methods looked up by copy, pickle etc.
+            raise AttributeError(name)
 
-        # the magic to convert instance attributes into method names
-        return partial(self, method=name)
+        if name in COMPLEX_METHODS:
+            proxy = _Namespace(self, name)
+        else:
+            proxy = _Method(self, name)
+        # setdefault: concurrent lookups get the same proxy
+        return self.__dict__.setdefault(name, proxy)
 
     def __call__(self, **kwargs):
         method = kwargs.pop('method')
-        params = self.defaults.copy()
-        params.update(kwargs)
-        return self._get(self.method_prefix + method, **params)
+        return getattr(self, method)(**kwargs)
+
+    def __copy__(self):
+        # cached proxies are bound to this instance and are not copied
+        api = self.__class__.__new__(self.__class__)
+        api.__dict__.update(
+            (key, value) for key, value in six.iteritems(self.__dict__)
+            if not isinstance(value, (_Method, _Namespace))
+        )
+        return api
 
     def _signature(self, params):
         return signature(self.api_secret, params)
 
     def _request(self, method, timeout=DEFAULT_TIMEOUT, **kwargs):
+        url, data, headers, secure = self._prepare_request(method, **kwargs)
+
+        # urllib2 doesn't support timeouts for python 2.5 so
+        # custom function is used for making http requests
+        return http.post(url, data, headers, timeout, secure=secure, pool=self.pool)
+
+    def _prepare_request(self, method, **kwargs):
 
         for key, value in six.iteritems(kwargs):
             kwargs[key] = _encode(value)
 
-        if self.token:
+        if self.token or self.token_pool is not None:
             # https://vk.com/dev/api_requests
             params = dict(
                 access_token=self.token,
@@ -159,7 +366,6 @@ class _API(object):
             params.update(kwargs)
             params['timestamp'] = int(time.time())
             url = SECURE_API_URL + method
-            secure = True
         else:
             # http://vkontakte.ru/developers.php?oid=-1&p=Взаимодействие_приложения_с_API
             params = dict(
@@ -173,18 +379,137 @@ class _API(object):
             params['timestamp'] = int(time.time())
             params['sig'] = self._signature(params)
             url = API_URL
-            secure = False
         data = urlencode(params)
+        secure = url.startswith('https:')
+
+        return url, data, REQUEST_HEADERS, secure
+
+
+class PreparedCall(object):
+    """
+    API method call with constant parameters encoded in advance.
+
+    Constant part of the request body is urlencoded once and, for signed
+    requests, constant ``key=value`` pairs are kept sorted for signature,
+    so only the arguments of a particular call (and timestamp/random)
+    are encoded per call. See :meth:`API.prepare`.
+    """
+
+    def __init__(self, api, method, **params):
+        self.api = api
+        self.method = method
+        self.params = api.defaults.copy()
+        self.params.update(params)
+        self.timeout = self.params.pop('timeout', DEFAULT_TIMEOUT)
+        self.idempotent = self.params.pop('idempotent', None)
+
+        encoded = dict((key, _encode(value)) for key, value in six.iteritems(self.params))
+        token_auth = api.token or api.token_pool is not None
+        if token_auth:
+            # tokens from the pool are added per call
+            base = dict(access_token=api.token) if api.token else {}
+            self.url = SECURE_API_URL + method
+        else:
+            base = dict(api_id=str(api.api_id), method=method, format='JSON', v='3.0')
+            self.url = API_URL
+        base.update(encoded)
+        # these are set for every request
+        self._volatile = ('timestamp',) if token_auth else ('timestamp', 'sig')
+        for key in self._volatile:
+            base.pop(key, None)
+        self.secure = self.url.startswith('https:')
+
+        self._keys = frozenset(base)
+        self._query = urlencode(base)
+        self._signed = None
+        if not token_auth:
+            self._signed = sorted(
+                (key, b"%s=%s" % (key.encode('utf8'), _encode(value)))
+                for key, value in six.iteritems(base)
+            )
 
-        headers = {"Accept": "application/json",
-                   "Content-Type": "application/x-www-form-urlencoded"}
-
-        # urllib2 doesn't support timeouts for python 2.5 so
-        # custom function is used for making http requests
-        return http.post(url, data, headers, timeout, secure=secure)
+    def __call__(self, **kwargs):
+        timeout = kwargs.pop('timeout', self.timeout)
+        idempotent = kwargs.pop('idempotent', self.idempotent)
+        if kwargs:
+            params = self.params.copy()
+            params.update(kwargs)
+        else:
+            params = self.params
+        return self.api._call(self.method, timeout, params, self, idempotent)["response"]
+
+    def _prepare_request(self, kwargs):
+        constant = self.params
+        variable = [
+            (key, _encode(value)) for key, value in six.iteritems(kwargs)
+            if (key not in constant or value is not constant[key]) and key not in self._volatile
+        ]
+        for key, value in variable:
+            if key in self._keys:
+                # constant parameter is overridden: nothing to reuse
+                return self.api._prepare_request(self.method, **kwargs)
+
+        variable.append(('timestamp', _encode(int(time.time()))))
+        if self._signed is not None:
+            if 'random' not in kwargs:
+                variable.append(('random', _encode(random.randint(0, 2 ** 30))))
+            pairs = list(self._signed)
+            for key, value in variable:
+                insort(pairs, (key, b"%s=%s" % (key.encode('utf8'), value)))
+            param_str = b"".join([pair for key, pair in pairs])
+            variable.append(('sig', md5(param_str + self.api.api_secret.encode('utf8')).hexdigest()))
+
+        data = self._query + '&' + urlencode(variable)
+        return self.url, data, REQUEST_HEADERS, self.secure
 
 
 class API(_API):
 
     def get(self, method, timeout=DEFAULT_TIMEOUT, **kwargs):
         return self._get(method, timeout, **kwargs)
+
+    def batch(self, size=MAX_BATCH_SIZE, timeout=None):
+        """
+        Return a :class:`vkontakte.batch.Batch` that sends queued calls
+        using ``execute`` method, up to ``size`` calls per request::
+
+            >>> with vk.batch() as batch:
+            ...     profiles = batch.users.get(user_ids='1,2')
+            ...     time = batch.getServerTime()
+            >>> profiles.result()
+        """
+        from vkontakte.batch import Batch
+        return Batch(self, size, timeout)
+
+    def iter(self, method, page_size=100, **kwargs):
+        """
+        Iterate over items of all pages of paginated ``method``
+        (see :func:`vkontakte.pagination.iterate` for options)::
+
+            >>> for member in vk.iter('groups.getMembers', group_id=1, page_size=1000):
+            ...     print member
+        """
+        from vkontakte.pagination import iterate
+        return iterate(self, method, page_size, **kwargs)
+
+    def map(self, method, params, concurrency=10, ordered=False):
+        """
+        Call ``method`` with each dict of ``params`` iterable from
+        ``concurrency`` threads and yield :class:`vkontakte.bulk.BulkResult`
+        objects as the calls complete (in input order if ``ordered``)::
+
+            >>> for item in vk.map('wall.get', [{'owner_id': 1}, {'owner_id': 2}]):
+            ...     print item.params, item.error or item.result
+        """
+        from vkontakte.bulk import bulk_map
+        return bulk_map(self, method, params, concurrency, ordered)
+
+    def prepare(self, method, **params):
+        """
+        Return a :class:`PreparedCall` of ``method`` with constant
+        ``params`` encoded once; the call takes the varying ones::
+
+            >>> get_users = vk.prepare('users.get', fields='sex,bdate')
+            >>> get_users(user_ids='1,2')
+        """
+        return PreparedCall(self, method, **params)
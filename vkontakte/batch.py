@@ -0,0 +1,162 @@
+# coding: utf-8
+"""
+Batching of API calls using ``execute`` method.
+
+``execute`` runs up to 25 API calls described in VKScript in a single
+request, so queued calls cost one http round trip (and one request
+against the rate limit) per 25 calls:
+
+    >>> with vk.batch() as batch:
+    ...     durov = batch.users.get(user_ids=1)
+    ...     friends = batch.friends.get(user_id=1)
+    >>> durov.result()
+    [{'id': 1, 'first_name': 'Павел', 'last_name': 'Дуров'}]
+
+Errors of individual calls are reported by ``result()`` of the
+corresponding call; other calls of the batch are not affected.
+"""
+import json
+from functools import partial
+
+import six
+
+from vkontakte.api import (COMPLEX_METHODS, DEFAULT_TIMEOUT, MAX_BATCH_SIZE,
+                           REQUEST_ENCODING, VKError, _encode)
+
+
+class BatchCall(object):
+    """ Result of a queued API call. """
+    __slots__ = ['method', 'params', '_done', '_result', '_error']
+
+    def __init__(self, method, params):
+        self.method = method
+        self.params = params
+        self._done = False
+        self._result = None
+        self._error = None
+
+    def done(self):
+        return self._done
+
+    def result(self):
+        """
+        Return the call result or raise its error: VKError of the call or
+        the exception that made the whole batch fail (e.g. socket.timeout).
+        """
+        if not self._done:
+            raise RuntimeError("Batch with %s call is not sent yet" % self.method)
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def _set_result(self, result):
+        self._result = result
+        self._done = True
+
+    def _set_error(self, error):
+        self._error = error
+        self._done = True
+
+
+class _BatchNamespace(object):
+    __slots__ = ['batch', 'method_prefix']
+
+    def __init__(self, batch, method_prefix):
+        self.batch = batch
+        self.method_prefix = method_prefix
+
+    def __getattr__(self, name):
+        return partial(self.batch.add, self.method_prefix + name)
+
+
+class Batch(object):
+    """
+    Queue of API calls. Calls are sent when ``size`` of them are queued,
+    when ``flush()`` is called or when ``with`` block is left.
+    """
+
+    def __init__(self, api, size=MAX_BATCH_SIZE, timeout=None):
+        if not (api.token or api.token_pool is not None):
+            raise ValueError("execute method requires token")
+        if not 0 < size <= MAX_BATCH_SIZE:
+            raise ValueError("Batch size must be between 1 and %d" % MAX_BATCH_SIZE)
+        self.api = api
+        self.size = size
+        self.defaults = api.defaults.copy()
+        self.timeout = self.defaults.pop('timeout', DEFAULT_TIMEOUT) if timeout is None else timeout
+        self._calls = []
+
+    def __getattr__(self, name):
+        """
+        Support for batch.<method>.<methodName> syntax
+        """
+        if name in COMPLEX_METHODS:
+            return _BatchNamespace(self, name + '.')
+        return partial(self.add, name)
+
+    def add(self, method, **kwargs):
+        """ Queue API call and return its :class:`BatchCall`. """
+        params = self.defaults.copy()
+        params.update(kwargs)
+        call = BatchCall(method, params)
+        self._calls.append(call)
+        if len(self._calls) >= self.size:
+            self.flush()
+        return call
+
+    def flush(self):
+        """ Send all queued calls. """
+        calls, self._calls = self._calls, []
+        if not calls:
+            return
+        try:
+            data = self.api._call('execute', self.timeout,
+                                  dict(self.defaults, code=_execute_code(calls)))
+        except Exception as e:
+            for call in calls:
+                call._set_error(e)
+            raise
+        _dispatch(calls, data["response"], data.get("execute_errors", []))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+
+def _execute_code(calls):
+    lines = []
+    for call in calls:
+        params = dict(
+            (key, _encode(value).decode(REQUEST_ENCODING))
+            for key, value in six.iteritems(call.params)
+        )
+        lines.append('API.%s(%s)' % (call.method, json.dumps(params, ensure_ascii=False)))
+    return 'return [%s];' % ', '.join(lines)
+
+
+def _dispatch(calls, results, errors):
+    """
+    Give each call its result. Failed calls return ``false`` and
+    their errors are listed in "execute_errors" in the same order.
+    """
+    errors = list(errors)
+    if len(results) != len(calls):
+        # calls without a result would otherwise stay not done forever
+        for call in calls[len(results):]:
+            call._set_error(ValueError("execute returned %d results for %d calls, no result for %s"
+                                       % (len(results), len(calls), call.method)))
+    for call, result in zip(calls, results):
+        if result is False:
+            for index, error in enumerate(errors):
+                if error.get('method') == call.method:
+                    error = errors.pop(index)
+                    error.setdefault('request_params', call.params)
+                    call._set_error(VKError(error))
+                    break
+            else:
+                call._set_result(result)
+        else:
+            call._set_result(result)
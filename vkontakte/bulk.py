@@ -0,0 +1,116 @@
+# coding: utf-8
+"""
+Calling the same API method with many sets of parameters from a pool
+of threads:
+
+    >>> params = ({'owner_id': owner_id, 'count': 100} for owner_id in owners)
+    >>> for item in vk.map('wall.get', params, concurrency=10):
+    ...     if item.error is None:
+    ...         print item.params['owner_id'], item.result['count']
+
+Results are yielded as soon as they are ready (or in the input order
+with ``ordered=True``). Errors are reported per item and don't stop the
+rest of the calls. The input iterable is consumed lazily: at most
+``2 * concurrency`` calls are pending at any time.
+"""
+import copy
+import threading
+from collections import namedtuple
+
+from six.moves import queue
+
+from vkontakte import http
+
+DEFAULT_CONCURRENCY = 10
+
+
+class BulkResult(namedtuple('BulkResult', 'index params result error')):
+    """
+    Outcome of a single call: ``index`` of ``params`` in the input,
+    ``result`` of the call or the exception it raised as ``error``.
+    """
+    __slots__ = ()
+
+    def get(self):
+        """ Return the result or raise the error. """
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+def _worker(api, method, tasks, results):
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        index, params = task
+        try:
+            result = BulkResult(index, params, api(method=method, **params), None)
+        except Exception as e:
+            result = BulkResult(index, params, None, e)
+        results.put(result)
+
+
+def bulk_map(api, method, params_iterable, concurrency=DEFAULT_CONCURRENCY, ordered=False):
+    """
+    Call ``method`` with each dict of ``params_iterable`` using
+    ``concurrency`` threads; yield :class:`BulkResult` objects.
+
+    Threads share ``api.pool``; if the API has no pool, a pool with
+    ``concurrency`` connections is made for the duration of the call.
+    """
+    own_pool = api.pool is None
+    if own_pool:
+        api = copy.copy(api)
+        api.pool = http.ConnectionPool(maxsize=concurrency)
+
+    tasks = queue.Queue()
+    results = queue.Queue()
+    threads = [threading.Thread(target=_worker, args=(api, method, tasks, results))
+               for i in range(concurrency)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    window = 2 * concurrency
+    params_iterator = enumerate(params_iterable)
+    pending = 0
+    exhausted = False
+    next_index = 0
+    done = {}
+
+    try:
+        while True:
+            while not exhausted and pending < window:
+                try:
+                    tasks.put(next(params_iterator))
+                    pending += 1
+                except StopIteration:
+                    exhausted = True
+            if not pending:
+                return
+
+            result = results.get()
+            if not ordered:
+                pending -= 1
+                yield result
+                continue
+
+            done[result.index] = result
+            while next_index in done:
+                pending -= 1
+                yield done.pop(next_index)
+                next_index += 1
+    finally:
+        # drop calls that were not started yet and stop the threads
+        try:
+            while True:
+                tasks.get_nowait()
+        except queue.Empty:
+            pass
+        for thread in threads:
+            tasks.put(None)
+        if own_pool:
+            # calls still in progress close their connections when
+            # the pool is garbage collected
+            api.pool.clear()
@@ -0,0 +1,193 @@
+# coding: utf-8
+"""
+Caching of responses of read-only API methods.
+
+    >>> cache = ResponseCache(maxsize=10000)
+    >>> vk = API(token='my_access_token', cache=cache)
+    >>> vk.users.get(user_ids=1)  # request is made
+    >>> vk.users.get(user_ids=1)  # response is taken from cache
+    >>> cache.stats()
+    {'hits': 1, 'misses': 1, 'evictions': 0, 'size': 1}
+
+Only methods from the allow-list are cached (see CACHEABLE_METHODS);
+cached objects are shared between callers and must not be modified.
+"""
+from __future__ import with_statement
+import os
+import pickle
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from hashlib import md5
+
+import six
+from six.moves.urllib.parse import urlencode
+
+from vkontakte.api import _encode
+
+# method name -> time to live (in seconds)
+CACHEABLE_METHODS = {
+    'getServerTime': 1,
+    'users.get': 300,
+    'groups.getById': 300,
+    'utils.resolveScreenName': 3600,
+    'database.getCountries': 86400,
+    'database.getRegions': 86400,
+    'database.getCities': 86400,
+    'database.getCitiesById': 86400,
+    'database.getCountriesById': 86400,
+}
+
+# parameters that differ between requests with the same meaning
+VOLATILE_PARAMS = frozenset(['timestamp', 'random', 'sig'])
+
+DEFAULT_MAXSIZE = 1024
+
+_MISSING = object()
+
+
+class MemoryBackend(object):
+    """ Thread-safe in-memory LRU storage with per-item expiration. """
+
+    def __init__(self, maxsize=DEFAULT_MAXSIZE):
+        self.maxsize = maxsize
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is None:
+                return default
+            if item[1] < time.time():
+                return default
+            self._data[key] = item  # move to the end: most recently used
+            return item[0]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, time.time() + ttl)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def __len__(self):
+        return len(self._data)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class FileBackend(object):
+    """
+    Storage in pickle files in ``directory``; it survives restarts
+    and can be shared by processes on the same host. Expired files are
+    removed when they are read.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.evictions = 0
+
+    def _path(self, key):
+        return os.path.join(self.directory, md5(key.encode('utf8')).hexdigest() + '.cache')
+
+    def get(self, key, default=None):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                stored_key, value, expires = pickle.load(f)
+        except (IOError, OSError, EOFError, ValueError, pickle.UnpicklingError):
+            return default
+        if expires < time.time():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return default
+        return value if stored_key == key else default
+
+    def set(self, key, value, ttl):
+        # write to a temporary file first so that readers never see
+        # partially written data
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump((key, value, time.time() + ttl), f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, self._path(key))
+
+    def __len__(self):
+        return len([name for name in os.listdir(self.directory) if name.endswith('.cache')])
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            if name.endswith('.cache'):
+                os.remove(os.path.join(self.directory, name))
+
+
+class ResponseCache(object):
+    """
+    Cache of API responses.
+
+    ``methods`` maps cacheable method names to their time to live
+    (CACHEABLE_METHODS by default); ``backend`` is an object with
+    ``get(key, default)`` and ``set(key, value, ttl)`` methods
+    (MemoryBackend with ``maxsize`` items by default).
+    """
+
+    def __init__(self, maxsize=DEFAULT_MAXSIZE, methods=None, backend=None):
+        self.methods = dict(CACHEABLE_METHODS if methods is None else methods)
+        for method in self.methods:
+            if method.startswith('secure.'):
+                raise ValueError("%s method can't be cached" % method)
+        self.backend = MemoryBackend(maxsize) if backend is None else backend
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def key(self, api, method, params):
+        """
+        Cache key for the call: method name, credentials and
+        encoded request parameters except the volatile ones.
+        """
+        items = sorted(
+            (key, _encode(value)) for key, value in six.iteritems(params)
+            if key not in VOLATILE_PARAMS
+        )
+        return '%s:%s:%s' % (method, api.token or api.api_id, urlencode(items))
+
+    def get(self, key):
+        value = self.backend.get(key, _MISSING)
+        with self._lock:
+            if value is _MISSING:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def call(self, api, method, params, func):
+        """
+        Return cached response for ``method`` call with ``params``
+        or call ``func`` to get the response and cache it.
+        """
+        key = self.key(api, method, params)
+        value = self.get(key)
+        if value is _MISSING:
+            value = func()
+            self.backend.set(key, value, self.methods[method])
+        return value
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': getattr(self.backend, 'evictions', 0),
+                'size': len(self.backend),
+            }
@@ -1,28 +1,192 @@
 #coding: utf-8
 
 from __future__ import with_statement
-from contextlib import closing
+import select
+import socket
+import threading
+import time
 from six.moves import http_client
 
 # urllib2 doesn't support timeouts for python 2.5 so
-# custom function is used for making http requests
+# custom functions are used for making http requests
 
-def post(url, data, headers, timeout, secure=False):
-    host_port = url.split('/')[2]
-    timeout_set = False
+DEFAULT_POOL_SIZE = 10
+DEFAULT_IDLE_TIMEOUT = 60
+
+
+def _connect(host_port, timeout, secure=False):
     connection = http_client.HTTPSConnection if secure else http_client.HTTPConnection
     try:
-        connection = connection(host_port, timeout=timeout)
-        timeout_set = True
+        return connection(host_port, timeout=timeout)
     except TypeError:
         connection = connection(host_port)
+        connection.connect()
+        connection.sock.settimeout(timeout)
+        return connection
+
+
+def _is_dropped(connection):
+    """
+    Check if idle ``connection`` was closed by the server: an idle
+    connection becomes readable only on EOF (or unexpected data).
+    """
+    sock = connection.sock
+    if sock is None:
+        return False
+    try:
+        if hasattr(select, 'poll'):
+            poller = select.poll()
+            poller.register(sock, select.POLLIN)
+            return bool(poller.poll(0))
+        return bool(select.select([sock], [], [], 0)[0])
+    except (select.error, ValueError):
+        return True
+
 
-    with closing(connection):
-        if not timeout_set:
-            connection.connect()
-            connection.sock.settimeout(timeout)
-            timeout_set = True
+def _send(connection, url, data, headers, stale_ok=False, trace=None):
+    """
+    Send the request and return (status, body, keep_alive) tuple.
+    Phase timings are added to ``trace`` if given.
 
+    If ``stale_ok`` is True and writing the request fails, None is
+    returned: the server didn't get the request and it can be safely
+    resent. Failures after the request was written are always raised
+    because the server may have already handled it.
+    """
+    if trace is not None:
+        trace.mark()
+    try:
         connection.request("POST", url, data, headers)
-        response = connection.getresponse()
-        return response.status, response.read()
+    except socket.timeout:
+        raise
+    except (socket.error, http_client.CannotSendRequest):
+        if stale_ok:
+            return None
+        raise
+
+    if trace is not None:
+        trace.lap('send')
+        trace.bytes_sent += len(data)
+    response = connection.getresponse()
+    if trace is not None:
+        trace.lap('wait')
+    body = response.read()
+    if trace is not None:
+        trace.lap('read')
+        trace.bytes_received += len(body)
+        trace.status = response.status
+    return response.status, body, not response.will_close
+
+
+class ConnectionPool(object):
+    """
+    Thread-safe pool of persistent (keep-alive) http connections.
+
+    Idle connections are kept per host and reused by subsequent requests,
+    so only the first request to a host pays for TCP (and TLS) handshake.
+    At most ``maxsize`` idle connections are kept per host; connections
+    that were idle for more than ``idle_timeout`` seconds are closed.
+    """
+
+    def __init__(self, maxsize=DEFAULT_POOL_SIZE, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _acquire(self, key):
+        now = time.time()
+        while True:
+            stale = []
+            connection = None
+            with self._lock:
+                idle = self._idle.get(key)
+                while idle:
+                    candidate, last_used = idle.pop()
+                    if now - last_used < self.idle_timeout:
+                        connection = candidate
+                        break
+                    stale.append(candidate)
+            for candidate in stale:
+                candidate.close()
+            if connection is None or not _is_dropped(connection):
+                return connection
+            # closed by the server while idle
+            connection.close()
+
+    def _release(self, key, connection):
+        now = time.time()
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            idle[:] = [item for item in idle if now - item[1] < self.idle_timeout]
+            if len(idle) < self.maxsize:
+                idle.append((connection, now))
+                return
+        connection.close()
+
+    def post(self, url, data, headers, timeout, secure=False, trace=None):
+        host_port = url.split('/')[2]
+        key = (secure, host_port)
+
+        connection = self._acquire(key)
+        if connection is not None:
+            if connection.sock is not None:
+                connection.sock.settimeout(timeout)
+            connection.timeout = timeout
+            try:
+                result = _send(connection, url, data, headers, stale_ok=True, trace=trace)
+            except Exception:
+                connection.close()
+                raise
+            if result is None:
+                # the server has dropped the idle connection before
+                # the request was written; send it using a fresh one
+                connection.close()
+                connection = None
+                if trace is not None:
+                    trace.resends += 1
+
+        if connection is None:
+            connection = _connect(host_port, timeout, secure)
+            try:
+                if trace is not None and connection.sock is None:
+                    # connect explicitly to tell handshake from sending
+                    trace.mark()
+                    connection.connect()
+                    trace.lap('connect')
+                result = _send(connection, url, data, headers, trace=trace)
+            except Exception:
+                connection.close()
+                raise
+
+        status, body, keep_alive = result
+
+        if keep_alive:
+            self._release(key, connection)
+        else:
+            connection.close()
+        return status, body
+
+    def clear(self):
+        """ Close all idle connections. """
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection, last_used in connections:
+                connection.close()
+
+
+default_pool = ConnectionPool()
+
+
+def post(url, data, headers, timeout, secure=False, pool=None, trace=None):
+    """
+    Make a POST request and return (status, body) tuple.
+    Connections are taken from ``pool`` (``default_pool`` if not given);
+    phase timings are added to ``trace`` (see vkontakte.instrumentation).
+    """
+    if pool is None:
+        pool = default_pool
+    if trace is None:
+        return pool.post(url, data, headers, timeout, secure=secure)
+    return pool.post(url, data, headers, timeout, secure=secure, trace=trace)
@@ -0,0 +1,237 @@
+# coding: utf-8
+"""
+Timings and counters of API calls.
+
+    >>> instrumentation = Instrumentation()
+    >>> metrics = MetricsAggregator()
+    >>> instrumentation.after_request(metrics.record)
+    >>> vk = API(token='my_access_token', instrumentation=instrumentation)
+    >>> vk.users.get(user_ids=1)
+    >>> metrics.stats()['users.get']['phases']['wait']['p99_ms']
+
+Every call gets a :class:`Trace` that is passed to ``before_request``
+hooks before the request is made and to ``after_request`` hooks when
+the call is done (successfully or not). Time is split into phases:
+
+* encode - building and signing the request body;
+* connect - TCP connection and TLS handshake (new connections only);
+* send - writing the request;
+* wait - waiting for the status line (server time and network latency);
+* read - reading the response body;
+* parse - decoding the response.
+
+API without ``instrumentation`` doesn't create traces at all.
+"""
+from __future__ import with_statement
+import threading
+import time
+
+from vkontakte.api import VKError
+
+try:
+    _clock = time.perf_counter
+except AttributeError:  # python 2
+    _clock = time.time
+
+PHASES = ('encode', 'connect', 'send', 'wait', 'read', 'parse')
+
+# upper bounds of histogram buckets, milliseconds
+HISTOGRAM_BOUNDS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250,
+                    500, 1000, 2500, 5000, 10000, float('inf'))
+
+
+class Trace(object):
+    """
+    Measurements of a single API call. ``attempts`` is the number of
+    requests made (0 for cached responses), ``resends`` is the number
+    of requests repeated on dropped keep-alive connections.
+    """
+    __slots__ = ['method', 'params', 'timings', 'bytes_sent', 'bytes_received',
+                 'attempts', 'resends', 'status', 'error', 'duration', '_started', '_last']
+
+    def __init__(self, method, params):
+        self.method = method
+        self.params = params
+        self.timings = {}
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.attempts = 0
+        self.resends = 0
+        self.status = None
+        self.error = None
+        self.duration = None
+        self._started = self._last = _clock()
+
+    def mark(self):
+        """ Start measuring a phase. """
+        self._last = _clock()
+
+    def lap(self, phase):
+        """ Add time since the last mark (or lap) to ``phase``. """
+        now = _clock()
+        self.timings[phase] = self.timings.get(phase, 0) + now - self._last
+        self._last = now
+
+    def finish(self, error=None):
+        self.error = error
+        self.duration = _clock() - self._started
+
+    @property
+    def retries(self):
+        return max(0, self.attempts - 1) + self.resends
+
+    @property
+    def error_code(self):
+        """ VK error code, exception class name or None. """
+        if self.error is None:
+            return None
+        if isinstance(self.error, VKError):
+            return self.error.code
+        return self.error.__class__.__name__
+
+
+class Instrumentation(object):
+    """
+    Hooks called for every call of API using this instrumentation.
+    Hooks are called with a :class:`Trace` in the calling thread.
+    """
+
+    def __init__(self):
+        self.before = []
+        self.after = []
+
+    def before_request(self, hook):
+        """ Add a hook called before the request (can be used as decorator). """
+        self.before.append(hook)
+        return hook
+
+    def after_request(self, hook):
+        """ Add a hook called when the call is done (can be used as decorator). """
+        self.after.append(hook)
+        return hook
+
+    def start(self, method, params):
+        trace = Trace(method, params)
+        for hook in self.before:
+            hook(trace)
+        return trace
+
+    def call(self, trace, func):
+        """ Call ``func`` and pass the finished ``trace`` to hooks. """
+        try:
+            result = func()
+        except Exception as e:
+            trace.finish(e)
+            self._done(trace)
+            raise
+        trace.finish()
+        self._done(trace)
+        return result
+
+    def _done(self, trace):
+        for hook in self.after:
+            hook(trace)
+
+
+class Histogram(object):
+    """ Histogram of durations with fixed logarithmic buckets. """
+
+    def __init__(self):
+        self.counts = [0] * len(HISTOGRAM_BOUNDS)
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, seconds):
+        ms = seconds * 1000
+        for index, bound in enumerate(HISTOGRAM_BOUNDS):
+            if ms <= bound:
+                self.counts[index] += 1
+                break
+        self.count += 1
+        self.total += ms
+
+    def percentile(self, fraction):
+        """ Upper bound (ms) of the bucket containing ``fraction`` of values. """
+        if not self.count:
+            return None
+        threshold = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= threshold:
+                return HISTOGRAM_BOUNDS[index]
+
+    def stats(self):
+        return {
+            'count': self.count,
+            'mean_ms': self.total / self.count if self.count else None,
+            'p50_ms': self.percentile(0.5),
+            'p99_ms': self.percentile(0.99),
+            'buckets': dict((bound, count) for bound, count
+                            in zip(HISTOGRAM_BOUNDS, self.counts) if count),
+        }
+
+
+class _MethodMetrics(object):
+
+    def __init__(self):
+        self.calls = 0
+        self.cached = 0
+        self.retries = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.errors = {}
+        self.total = Histogram()
+        self.phases = dict((phase, Histogram()) for phase in PHASES)
+
+    def stats(self):
+        return {
+            'calls': self.calls,
+            'cached': self.cached,
+            'retries': self.retries,
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received,
+            'errors': dict(self.errors),
+            'total': self.total.stats(),
+            'phases': dict((phase, histogram.stats())
+                           for phase, histogram in self.phases.items() if histogram.count),
+        }
+
+
+class MetricsAggregator(object):
+    """
+    Thread-safe in-process aggregator of traces: counters and
+    histograms of call and phase durations per method. Use
+    ``record`` as an ``after_request`` hook.
+    """
+
+    def __init__(self):
+        self._methods = {}
+        self._lock = threading.Lock()
+
+    def record(self, trace):
+        with self._lock:
+            metrics = self._methods.get(trace.method)
+            if metrics is None:
+                metrics = self._methods[trace.method] = _MethodMetrics()
+            metrics.calls += 1
+            if not trace.attempts and trace.error is None:
+                metrics.cached += 1
+            metrics.retries += trace.retries
+            metrics.bytes_sent += trace.bytes_sent
+            metrics.bytes_received += trace.bytes_received
+            code = trace.error_code
+            if code is not None:
+                metrics.errors[code] = metrics.errors.get(code, 0) + 1
+            metrics.total.add(trace.duration)
+            for phase, seconds in trace.timings.items():
+                metrics.phases[phase].add(seconds)
+
+    def stats(self):
+        """ {method: {calls, cached, retries, bytes_sent, bytes_received, errors, total, phases}} """
+        with self._lock:
+            return dict((method, metrics.stats()) for method, metrics in self._methods.items())
+
+    def clear(self):
+        with self._lock:
+            self._methods = {}
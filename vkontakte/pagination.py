@@ -0,0 +1,125 @@
+# coding: utf-8
+"""
+Lazy iteration over paginated API methods.
+
+    >>> for member in vk.iter('groups.getMembers', group_id=1, page_size=1000):
+    ...     print member
+
+Pages are requested one at a time using ``offset``/``count`` parameters,
+or ``start_from`` when the response has ``next_from`` cursor (e.g.
+``newsfeed.get``), so only the current page (and the next one when
+``prefetch`` is enabled) is kept in memory.
+
+Responses of API versions before 5.0 (the default without ``v``
+parameter) may be lists starting with the total count, e.g. ``[count,
+post, post, ...]`` of ``wall.get``. The count is recognized when it is
+followed by non-integer items (or the list is just ``[0]``); the rest of
+the pages are then handled the same way. A first page made of a single
+integer is ambiguous and is taken for an item, so pass ``v='5.0'`` or
+later to get unambiguous ``{"count": ..., "items": [...]}`` responses.
+"""
+import threading
+
+import six
+
+DEFAULT_PAGE_SIZE = 100
+
+
+class _Prefetch(threading.Thread):
+    """ Request a page in a background thread. """
+
+    def __init__(self, fetch, params):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.fetch = fetch
+        self.params = params
+        self.response = None
+        self.error = None
+        self.start()
+
+    def run(self):
+        try:
+            self.response = self.fetch(self.params)
+        except Exception as e:
+            self.error = e
+
+    def result(self):
+        self.join()
+        if self.error is not None:
+            raise self.error
+        return self.response
+
+
+def _is_int(value):
+    return isinstance(value, six.integer_types) and not isinstance(value, bool)
+
+
+def _starts_with_count(response):
+    """ Check if list response looks like ``[count, item, ...]``. """
+    if response == [0]:
+        return True
+    return (len(response) > 1 and _is_int(response[0]) and
+            not any(_is_int(item) for item in response[1:]))
+
+
+def _split_page(response, items_key, counted=False):
+    """
+    Return (items, total count, next_from) for API response; list
+    response starts with the total count if ``counted`` is True.
+    """
+    if isinstance(response, dict):
+        return response.get(items_key) or [], response.get('count'), response.get('next_from')
+    if counted and response:
+        return response[1:], response[0], None
+    return response or [], None, None
+
+
+def iterate(api, method, page_size=DEFAULT_PAGE_SIZE, offset=0, limit=None,
+            prefetch=False, items_key='items', **kwargs):
+    """
+    Yield items of all pages of ``method`` response, at most ``limit``
+    items if it is given. With ``prefetch=True`` the next page is
+    requested in background while the current one is being consumed.
+    """
+    def fetch(params):
+        return api(method=method, **params)
+
+    params = dict(kwargs, count=page_size, offset=offset)
+    response = fetch(params)
+    yielded = 0
+    counted = None
+
+    while True:
+        if counted is None and isinstance(response, list):
+            counted = _starts_with_count(response)
+        items, total, next_from = _split_page(response, items_key, counted)
+        response = None
+
+        if next_from:
+            params.pop('offset', None)
+            params['start_from'] = next_from
+            has_next = True
+        elif 'start_from' in params:
+            has_next = False
+        else:
+            params['offset'] += len(items)
+            if total is not None:
+                has_next = params['offset'] < total
+            else:
+                has_next = len(items) >= page_size
+        has_next = has_next and bool(items)
+        if limit is not None:
+            has_next = has_next and yielded + len(items) < limit
+
+        next_page = _Prefetch(fetch, dict(params)) if has_next and prefetch else None
+
+        for item in items:
+            if limit is not None and yielded >= limit:
+                return
+            yield item
+            yielded += 1
+        items = None
+
+        if not has_next:
+            return
+        response = next_page.result() if next_page is not None else fetch(params)
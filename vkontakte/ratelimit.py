@@ -0,0 +1,193 @@
+# coding: utf-8
+"""
+Client-side rate limiting for vk.com API.
+
+vk.com allows only a few requests per second per access token (or
+application) and responds with error 6 ("Too many requests per second")
+otherwise. RateLimiter spaces requests out using a token bucket per
+token/api_id and retries throttled requests with exponential backoff.
+
+    >>> limiter = RateLimiter(rate=3)
+    >>> vk = API(token='my_access_token', rate_limiter=limiter)
+    >>> limiter.stats()
+    {'calls': 0, 'throttled': 0, 'wait_time': 0.0, 'retries': 0}
+"""
+from __future__ import with_statement
+import json
+import os
+import random
+import threading
+import time
+from hashlib import md5
+
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+
+from vkontakte.api import VKError
+
+TOO_MANY_REQUESTS = 6
+
+DEFAULT_RATE = 3
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_BACKOFF = 0.5
+DEFAULT_MAX_BACKOFF = 30
+
+
+def backoff_delay(attempt, backoff, max_backoff):
+    """
+    Delay before retry number ``attempt`` (starting from 0): exponential
+    backoff with "equal jitter".
+    """
+    delay = min(max_backoff, backoff * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket: ``rate`` requests per second on average
+    with bursts of up to ``capacity`` requests.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self._tokens = self.capacity
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def _reserve(self, tokens, updated, now):
+        tokens = min(self.capacity, tokens + (now - updated) * self.rate) - 1
+        wait = -tokens / self.rate if tokens < 0 else 0.0
+        return tokens, wait
+
+    def reserve(self):
+        """
+        Reserve a slot for one request and return the number
+        of seconds the caller should wait before making it.
+        """
+        with self._lock:
+            now = time.time()
+            self._tokens, wait = self._reserve(self._tokens, self._updated, now)
+            self._updated = now
+        return wait
+
+
+class FileTokenBucket(TokenBucket):
+    """
+    Token bucket with state stored in a file so that it is shared
+    between processes on the same host. Requires ``fcntl`` (POSIX).
+    """
+
+    def __init__(self, path, rate, capacity=None):
+        if fcntl is None:
+            raise RuntimeError("FileTokenBucket requires fcntl module")
+        super(FileTokenBucket, self).__init__(rate, capacity)
+        self.path = path
+
+    def reserve(self):
+        with self._lock:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                try:
+                    tokens, updated = json.loads(os.read(fd, 1024).decode('ascii'))
+                except ValueError:
+                    tokens, updated = self.capacity, 0
+                now = time.time()
+                tokens, wait = self._reserve(tokens, updated, now)
+                state = json.dumps([tokens, now]).encode('ascii')
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.ftruncate(fd, 0)
+                os.write(fd, state)
+            finally:
+                os.close(fd)
+        return wait
+
+
+class RateLimiter(object):
+    """
+    Keeps a token bucket per key (access token or api_id), makes callers
+    wait for their turn and retries requests failed with error 6.
+
+    If ``directory`` is given, bucket state is kept in files in this
+    directory and the limit is shared by all processes using it.
+    Instances are thread-safe and can be shared by many API objects.
+    """
+
+    def __init__(self, rate=DEFAULT_RATE, capacity=None, max_retries=DEFAULT_MAX_RETRIES,
+                 backoff=DEFAULT_BACKOFF, max_backoff=DEFAULT_MAX_BACKOFF, directory=None):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.directory = directory
+
+        self.calls = 0
+        self.throttled = 0
+        self.wait_time = 0.0
+        self.retries = 0
+
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _create_bucket(self, key):
+        if self.directory is None:
+            return TokenBucket(self.rate, self.capacity)
+        filename = md5(key.encode('utf8')).hexdigest() + '.bucket'
+        return FileTokenBucket(os.path.join(self.directory, filename), self.rate, self.capacity)
+
+    def bucket(self, key):
+        key = str(key)
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = self._create_bucket(key)
+        return bucket
+
+    def _sleep(self, seconds):
+        with self._lock:
+            self.wait_time += seconds
+        time.sleep(seconds)
+
+    def acquire(self, key):
+        """ Block until a request for ``key`` may be made. """
+        wait = self.bucket(key).reserve()
+        with self._lock:
+            self.calls += 1
+            if wait > 0:
+                self.throttled += 1
+        if wait > 0:
+            self._sleep(wait)
+
+    def backoff_delay(self, attempt):
+        return backoff_delay(attempt, self.backoff, self.max_backoff)
+
+    def call(self, key, func, *args, **kwargs):
+        """
+        Call ``func`` when the rate limit for ``key`` allows it; retry it
+        when it fails with "Too many requests per second" error.
+        """
+        attempt = 0
+        while True:
+            self.acquire(key)
+            try:
+                return func(*args, **kwargs)
+            except VKError as e:
+                if e.code != TOO_MANY_REQUESTS or attempt >= self.max_retries:
+                    raise
+            with self._lock:
+                self.retries += 1
+            self._sleep(self.backoff_delay(attempt))
+            attempt += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'calls': self.calls,
+                'throttled': self.throttled,
+                'wait_time': self.wait_time,
+                'retries': self.retries,
+            }
@@ -0,0 +1,175 @@
+# coding: utf-8
+"""
+Retrying API calls failed with transient errors.
+
+    >>> policy = RetryPolicy(max_attempts=4, deadline=10, circuit_breaker=CircuitBreaker())
+    >>> vk = API(token='my_access_token', retry=policy)
+    >>> vk.users.get(user_ids=1)                      # retried (read method)
+    >>> vk.wall.post(message='hi')                    # not retried
+    >>> vk.wall.post(message='hi', idempotent=True)   # retried
+
+Transient errors are socket errors and timeouts, HTTP 429 and 5xx
+responses and VK errors 1 (unknown error), 6 (too many requests per
+second) and 10 (internal server error). Error 6 is left to the
+RateLimiter of the API if it has one. Only calls of read methods
+(``*.get*``, ``*.search*``, ``*.is*``, ...), methods listed in
+``idempotent_methods`` and calls made with ``idempotent=True`` are
+repeated: other calls may have been handled by the server before they
+failed.
+
+Each attempt uses the socket timeout of the call, but the whole call
+(with backoff delays) takes no longer than ``deadline`` seconds.
+Retries use the connection pool of the API, so they don't pay for a
+new connection unless the failed one was closed.
+"""
+from __future__ import with_statement
+import socket
+import threading
+import time
+
+from six.moves import http_client
+
+from vkontakte.api import VKError, HTTPError
+from vkontakte.ratelimit import TOO_MANY_REQUESTS, backoff_delay
+
+TRANSIENT_ERRORS = (1, 6, 10)
+TRANSIENT_STATUSES = (429, 500, 502, 503, 504)
+TRANSIENT_EXCEPTIONS = (socket.error, http_client.HTTPException)
+
+# verbs of read-only methods, e.g. users.get, groups.isMember, friends.areFriends
+READ_PREFIXES = ('get', 'search', 'is', 'are', 'check', 'resolve')
+
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_BACKOFF = 0.5
+DEFAULT_MAX_BACKOFF = 10
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_TIMEOUT = 30
+
+
+class CircuitOpenError(Exception):
+    """ The call was not made because api.vk.com seems to be degraded. """
+
+
+class CircuitBreaker(object):
+    """
+    Thread-safe circuit breaker. After ``failure_threshold`` consecutive
+    failures (timeouts, connection errors, server errors) calls fail
+    fast with :class:`CircuitOpenError`; every ``reset_timeout`` seconds
+    one call is let through to check if the API has recovered.
+    """
+
+    def __init__(self, failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+                 reset_timeout=DEFAULT_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def before_call(self):
+        """ Raise CircuitOpenError unless a call may be made. """
+        with self._lock:
+            if self.opened_at is None:
+                return
+            now = time.time()
+            if now - self.opened_at < self.reset_timeout:
+                raise CircuitOpenError("Circuit is open after %d failures" % self.failures)
+            # let this call through; the rest fail fast until it is done
+            self.opened_at = now
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                self.opened_at = time.time()
+
+
+def is_transient(error):
+    if isinstance(error, HTTPError):
+        return error.code in TRANSIENT_STATUSES
+    if isinstance(error, VKError):
+        return error.code in TRANSIENT_ERRORS
+    return isinstance(error, TRANSIENT_EXCEPTIONS)
+
+
+def _is_degraded(error):
+    # throttling is not a sign of server problems
+    if isinstance(error, VKError) and error.code in (TOO_MANY_REQUESTS, 429):
+        return False
+    return is_transient(error)
+
+
+class RetryPolicy(object):
+    """
+    Retries of transient failures with exponential backoff (with jitter)
+    limited by ``max_attempts`` and ``deadline`` (seconds per call,
+    None for no limit). Instances are thread-safe and can be shared by
+    many API objects.
+    """
+
+    def __init__(self, max_attempts=DEFAULT_MAX_ATTEMPTS, backoff=DEFAULT_BACKOFF,
+                 max_backoff=DEFAULT_MAX_BACKOFF, deadline=None, idempotent_methods=(),
+                 circuit_breaker=None):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.deadline = deadline
+        self.idempotent_methods = frozenset(idempotent_methods)
+        self.circuit_breaker = circuit_breaker
+
+    def is_idempotent(self, method):
+        if method in self.idempotent_methods:
+            return True
+        return method.rsplit('.', 1)[-1].startswith(READ_PREFIXES)
+
+    def backoff_delay(self, attempt):
+        return backoff_delay(attempt, self.backoff, self.max_backoff)
+
+    def call(self, method, timeout, func, idempotent=None, rate_limited=False):
+        """
+        Call ``func(timeout)``, retrying it on transient errors if
+        ``method`` is idempotent (or ``idempotent`` is True). Error 6
+        is not retried if ``rate_limited``: the rate limiter handles it.
+        """
+        if idempotent is None:
+            idempotent = self.is_idempotent(method)
+        breaker = self.circuit_breaker
+        deadline = None if self.deadline is None else time.time() + self.deadline
+
+        attempt = 0
+        while True:
+            if breaker is not None:
+                breaker.before_call()
+            attempt_timeout = timeout
+            if deadline is not None:
+                attempt_timeout = max(0.001, min(timeout, deadline - time.time()))
+            try:
+                result = func(attempt_timeout)
+            except Exception as e:
+                if breaker is not None:
+                    if _is_degraded(e):
+                        breaker.failure()
+                    else:
+                        breaker.success()
+                if not idempotent or attempt + 1 >= self.max_attempts or not is_transient(e):
+                    raise
+                if rate_limited and isinstance(e, VKError) and e.code == TOO_MANY_REQUESTS:
+                    raise
+                delay = self.backoff_delay(attempt)
+                if deadline is not None and time.time() + delay >= deadline:
+                    raise
+                time.sleep(delay)
+                attempt += 1
+                continue
+            if breaker is not None:
+                breaker.success()
+            return result
@@ -7,13 +7,24 @@ Requires mock >= 0.7.2.
 
 import os
 import sys
-from six.moves.urllib.parse import unquote
+from six.moves.urllib.parse import parse_qsl, unquote
 sys.path.insert(0, os.path.abspath('..'))
 
+import shutil
+import socket
+import tempfile
+import threading
 import unittest
 import mock
+from six.moves import BaseHTTPServer, socketserver
 import vkontakte
 import vkontakte.api
+import vkontakte.cache
+import vkontakte.http
+import vkontakte.instrumentation
+import vkontakte.ratelimit
+import vkontakte.retry
+import vkontakte.tokens
 
 API_ID = 'api_id'
 API_SECRET = 'api_secret'
@@ -45,6 +56,28 @@ class IterparseTest(unittest.TestCase):
         self.assertEqual(parses[0]["error"]["}{"], "foo")
         self.assertEqual(parses[1]["foo"], "bar")
 
+    def test_iterparse_invalid_utf8(self):
+        parses = list(vkontakte.api._json_iterparse(b'{"response": "\xd0\xbf\xd0"}'))
+        self.assertEqual(parses, [{"response": u"\u043f"}])
+
+    def test_iterparse_control_characters(self):
+        parses = list(vkontakte.api._json_iterparse(b'{"response": "a\nb"}'))
+        self.assertEqual(parses, [{"response": "a\nb"}])
+
+    def test_json_backends(self):
+        self.addCleanup(vkontakte.api.set_json_backend, 'json')
+        for name in vkontakte.api.JSON_BACKENDS:
+            try:
+                vkontakte.api.set_json_backend(name)
+            except ImportError:
+                continue
+            self.test_iterparse()
+            self.test_iterparse_edge()
+            self.test_iterparse_invalid_utf8()
+            self.test_iterparse_control_characters()
+        vkontakte.api.set_json_backend('auto')
+        self.assertRaises(ValueError, vkontakte.api.set_json_backend, 'pickle')
+
 
 
 class VkontakteMagicTest(unittest.TestCase):
@@ -117,5 +150,956 @@ class VkontakteMagicTest(unittest.TestCase):
         comments = self.api.get('wall.getComments', **kwargs)
         self.assertEqual(len(comments), 36)
 
+    def test_proxies_are_cached(self):
+        self.assertTrue(self.api.friends is self.api.friends)
+        self.assertTrue(self.api.friends.get is self.api.friends.get)
+        self.assertTrue(self.api.getServerTime is self.api.getServerTime)
+        other = vkontakte.API(API_ID, API_SECRET)
+        self.assertFalse(other.friends.get is self.api.friends.get)
+
+    @mock.patch('vkontakte.api._API._get')
+    def test_defaults_are_not_modified(self, _get):
+        api = vkontakte.API(API_ID, API_SECRET, v='5.0')
+        api.users.get(user_ids=1)
+        api.users.get(user_ids=2, v='5.1')
+        self.assertEqual(api.defaults, {'v': '5.0'})
+        self.assertEqual(_get.call_args_list, [
+            mock.call('users.get', user_ids=1, v='5.0'),
+            mock.call('users.get', user_ids=2, v='5.1'),
+        ])
+
+    def test_custom_pool_without_trace(self):
+        class Pool(object):
+            def post(self, url, data, headers, timeout, secure=False):
+                return 200, b'{"response":1}'
+        api = vkontakte.API(token='token', pool=Pool())
+        self.assertEqual(api.users.get(user_ids=1), 1)
+
+    @mock.patch('vkontakte.http.post')
+    def test_pool_is_passed(self, post):
+        post.return_value = 200, '{"response":123}'.encode('utf-8')
+        pool = vkontakte.ConnectionPool()
+        api = vkontakte.API(API_ID, API_SECRET, pool=pool)
+        api.friends.get(uid=1)
+        self.assertTrue(post.call_args[1]['pool'] is pool)
+
+
+class FakeConnection(object):
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.sock = None
+        self.closed = False
+        self.requests = 0
+
+    def request(self, method, url, data, headers):
+        if isinstance(self.responses[0], SendError):
+            raise self.responses.pop(0).exception
+        self.requests += 1
+
+    def getresponse(self):
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def close(self):
+        self.closed = True
+
+
+class SendError(object):
+    """ Marks an exception raised by FakeConnection.request() """
+    def __init__(self, exception):
+        self.exception = exception
+
+
+def fake_response(body, will_close=False):
+    response = mock.Mock(status=200, will_close=will_close)
+    response.read.return_value = body
+    return response
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    url = 'https://api.vk.com/method/getServerTime'
+
+    @mock.patch('vkontakte.http._connect')
+    def test_connection_reuse(self, connect):
+        connection = FakeConnection([fake_response(b'1'), fake_response(b'2')])
+        connect.return_value = connection
+        pool = vkontakte.http.ConnectionPool()
+        self.assertEqual(pool.post(self.url, '', {}, 1, secure=True), (200, b'1'))
+        self.assertEqual(pool.post(self.url, '', {}, 1, secure=True), (200, b'2'))
+        self.assertEqual(connect.call_count, 1)
+        self.assertEqual(connection.requests, 2)
+
+    @mock.patch('vkontakte.http._connect')
+    def test_closed_connections_are_not_reused(self, connect):
+        connect.side_effect = lambda *args: FakeConnection([fake_response(b'1', will_close=True)])
+        pool = vkontakte.http.ConnectionPool()
+        pool.post(self.url, '', {}, 1, secure=True)
+        pool.post(self.url, '', {}, 1, secure=True)
+        self.assertEqual(connect.call_count, 2)
+
+    @mock.patch('vkontakte.http._connect')
+    def test_idle_eviction(self, connect):
+        connect.side_effect = lambda *args: FakeConnection([fake_response(b'1')])
+        pool = vkontakte.http.ConnectionPool(idle_timeout=0)
+        pool.post(self.url, '', {}, 1, secure=True)
+        pool.post(self.url, '', {}, 1, secure=True)
+        self.assertEqual(connect.call_count, 2)
+
+    @mock.patch('vkontakte.http._connect')
+    def test_dropped_idle_connection_is_not_used(self, connect):
+        stale = FakeConnection([fake_response(b'1')])
+        stale.sock, server_side = socket.socketpair()
+        self.addCleanup(stale.sock.close)
+        fresh = FakeConnection([fake_response(b'2')])
+        connect.side_effect = [stale, fresh]
+        pool = vkontakte.http.ConnectionPool()
+        pool.post(self.url, '', {}, 1, secure=True)
+        server_side.close()
+        self.assertEqual(pool.post(self.url, '', {}, 1, secure=True), (200, b'2'))
+        self.assertEqual(stale.requests, 1)
+        self.assertTrue(stale.closed)
+
+    @mock.patch('vkontakte.http._connect')
+    def test_no_status_line_is_not_resent(self, connect):
+        stale = FakeConnection([fake_response(b'1'), vkontakte.http.http_client.BadStatusLine('')])
+        connect.side_effect = [stale]
+        pool = vkontakte.http.ConnectionPool()
+        pool.post(self.url, '', {}, 1, secure=True)
+        self.assertRaises(vkontakte.http.http_client.BadStatusLine,
+                          pool.post, self.url, '', {}, 1, secure=True)
+        self.assertEqual(connect.call_count, 1)
+        self.assertTrue(stale.closed)
+
+    @mock.patch('vkontakte.http._connect')
+    def test_broken_pipe_on_send_reconnect(self, connect):
+        stale = FakeConnection([fake_response(b'1'), SendError(IOError(32, 'Broken pipe'))])
+        fresh = FakeConnection([fake_response(b'2')])
+        connect.side_effect = [stale, fresh]
+        pool = vkontakte.http.ConnectionPool()
+        pool.post(self.url, '', {}, 1, secure=True)
+        self.assertEqual(pool.post(self.url, '', {}, 1, secure=True), (200, b'2'))
+        self.assertEqual(fresh.requests, 1)
+
+    @mock.patch('vkontakte.http._connect')
+    def test_reset_after_send_is_not_resent(self, connect):
+        # the request may have been processed by the server: sending
+        # it once more could e.g. duplicate a wall post
+        reset = IOError(104, 'Connection reset by peer')
+        stale = FakeConnection([fake_response(b'1'), reset])
+        connect.side_effect = [stale]
+        pool = vkontakte.http.ConnectionPool()
+        pool.post(self.url, '', {}, 1, secure=True)
+        self.assertRaises(IOError, pool.post, self.url, '', {}, 1, secure=True)
+        self.assertEqual(connect.call_count, 1)
+        self.assertEqual(stale.requests, 2)
+        self.assertTrue(stale.closed)
+
+    @mock.patch('vkontakte.http._connect')
+    def test_pool_size(self, connect):
+        connections = [FakeConnection([fake_response(b'1')]) for i in range(3)]
+        pool = vkontakte.http.ConnectionPool(maxsize=2)
+        for connection in connections:
+            pool._release((True, 'api.vk.com'), connection)
+        self.assertEqual([c.closed for c in connections], [False, False, True])
+        pool.clear()
+        self.assertTrue(all(c.closed for c in connections))
+
+
+class FakeVKHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.server.requests.append((self.path, self.client_address))
+        body = '{"response":%d}' % len(self.server.requests)
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body.encode('utf-8'))
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeVKServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class FakeVKServerMixin(object):
+
+    def setUp(self):
+        self.server = FakeVKServer(('127.0.0.1', 0), FakeVKHandler)
+        self.server.requests = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:%d/method/getServerTime' % self.server.server_port
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@unittest.skipIf(sys.version_info < (3, 5), "asyncio client requires python 3.5+")
+class AsyncAPITest(FakeVKServerMixin, unittest.TestCase):
+
+    def run_coroutine(self, coroutine):
+        import asyncio
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coroutine)
+        finally:
+            loop.close()
+
+    def fake_pool(self, body):
+        import asyncio
+        pool = mock.Mock()
+
+        def post(*args, **kwargs):
+            future = asyncio.get_event_loop().create_future()
+            future.set_result((200, body))
+            return future
+
+        pool.post.side_effect = post
+        return pool
+
+    def test_magic(self):
+        pool = self.fake_pool(b'{"response":[1, 2]}')
+        api = vkontakte.AsyncAPI(token='token', pool=pool)
+        self.assertEqual(self.run_coroutine(api.friends.get(uid=1)), [1, 2])
+        self.assertTrue(pool.post.call_args[0][0].endswith('/method/friends.get'))
+
+    def test_get(self):
+        pool = self.fake_pool(b'{"response":123}')
+        api = vkontakte.AsyncAPI(API_ID, API_SECRET, pool=pool)
+        self.assertEqual(self.run_coroutine(api.get('getServerTime')), 123)
+        self.assertTrue('method=getServerTime' in pool.post.call_args[0][1])
+
+    def test_error(self):
+        pool = self.fake_pool(b'{"error":{"error_code":5,"error_msg":"auth","request_params":[]}}')
+        api = vkontakte.AsyncAPI(token='token', pool=pool)
+        self.assertRaises(vkontakte.VKError, self.run_coroutine, api.getServerTime())
+
+    def test_unsupported_options(self):
+        for option in ('token_pool', 'rate_limiter', 'cache', 'retry', 'instrumentation'):
+            self.assertRaises(TypeError, vkontakte.AsyncAPI, token='token', **{option: object()})
+
+    def test_connection_reuse(self):
+        import asyncio
+        pool = vkontakte.AsyncConnectionPool()
+        loop = asyncio.new_event_loop()
+        try:
+            for i in range(3):
+                status, body = loop.run_until_complete(pool.post(self.url, 'a=1', {}, 5))
+                self.assertEqual((status, body), (200, ('{"response":%d}' % (i + 1)).encode('utf-8')))
+            loop.run_until_complete(pool.clear())
+        finally:
+            loop.close()
+        self.assertEqual(len(set(client for path, client in self.server.requests)), 1)
+        self.assertEqual(self.server.requests[0][0], '/method/getServerTime')
+
+    def test_pool_reused_in_another_loop(self):
+        pool = vkontakte.AsyncConnectionPool()
+        self.assertEqual(self.run_coroutine(pool.post(self.url, 'a=1', {}, 5))[0], 200)
+        self.assertEqual(self.run_coroutine(pool.post(self.url, 'a=1', {}, 5))[0], 200)
+        self.run_coroutine(pool.clear())
+        self.assertEqual(len(set(client for path, client in self.server.requests)), 2)
+
+    def test_dropped_idle_connection_is_not_used(self):
+        import asyncio
+        pool = vkontakte.AsyncConnectionPool()
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(pool.post(self.url, 'a=1', {}, 5))
+            [idle] = pool._idle.values()
+            idle[0].reader.feed_eof()  # FIN from the server
+            self.assertEqual(loop.run_until_complete(pool.post(self.url, 'a=1', {}, 5))[0], 200)
+            loop.run_until_complete(pool.clear())
+        finally:
+            loop.close()
+        self.assertEqual(len(set(client for path, client in self.server.requests)), 2)
+
+    def test_incomplete_chunked_response(self):
+        import asyncio
+        reader = asyncio.StreamReader()
+        reader.feed_data(b'Transfer-Encoding: chunked\r\n\r\n5\r\nabcde\r\n')
+        reader.feed_eof()
+        coroutine = vkontakte.aio._read_response(reader, b'HTTP/1.1 200 OK\r\n')
+        self.assertRaises(ConnectionResetError, self.run_coroutine, coroutine)
+
+
+def vk_error(code):
+    return vkontakte.VKError({'error_code': code, 'error_msg': 'error', 'request_params': []})
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    @mock.patch('vkontakte.ratelimit.time')
+    def test_token_bucket(self, time):
+        time.time.return_value = 100
+        bucket = vkontakte.ratelimit.TokenBucket(rate=2, capacity=2)
+        self.assertEqual([bucket.reserve() for i in range(4)], [0, 0, 0.5, 1.0])
+        time.time.return_value = 102
+        self.assertEqual(bucket.reserve(), 0)
+
+    @mock.patch('vkontakte.ratelimit.time')
+    def test_file_token_bucket_is_shared(self, time):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        time.time.return_value = 100
+        first = vkontakte.RateLimiter(rate=1, directory=directory)
+        second = vkontakte.RateLimiter(rate=1, directory=directory)
+        self.assertEqual(first.bucket('token').reserve(), 0)
+        self.assertEqual(second.bucket('token').reserve(), 1)
+        self.assertEqual(second.bucket('other').reserve(), 0)
+
+    @mock.patch('vkontakte.ratelimit.time')
+    def test_throttling_stats(self, time):
+        time.time.return_value = 100
+        limiter = vkontakte.RateLimiter(rate=1)
+        limiter.acquire('token')
+        limiter.acquire('token')
+        time.sleep.assert_called_once_with(1)
+        self.assertEqual(limiter.stats(), {'calls': 2, 'throttled': 1, 'wait_time': 1, 'retries': 0})
+
+    @mock.patch('vkontakte.ratelimit.time')
+    @mock.patch('vkontakte.http.post')
+    def test_too_many_requests_retry(self, post, time):
+        time.time.return_value = 100
+        post.side_effect = [
+            (200, b'{"error":{"error_code":6,"error_msg":"Too many requests per second","request_params":[]}}'),
+            (200, b'{"response":123}'),
+        ]
+        limiter = vkontakte.RateLimiter(rate=100)
+        api = vkontakte.API(token='token', rate_limiter=limiter)
+        self.assertEqual(api.users.get(uid=1), 123)
+        self.assertEqual(post.call_count, 2)
+        self.assertEqual(limiter.stats()['retries'], 1)
+
+    @mock.patch('vkontakte.ratelimit.time')
+    def test_retries_limit(self, time):
+        time.time.return_value = 100
+        func = mock.Mock(side_effect=vk_error(6))
+        limiter = vkontakte.RateLimiter(rate=100, max_retries=2)
+        self.assertRaises(vkontakte.VKError, limiter.call, 'token', func)
+        self.assertEqual(func.call_count, 3)
+
+    def test_other_errors_are_not_retried(self):
+        func = mock.Mock(side_effect=vk_error(5))
+        limiter = vkontakte.RateLimiter()
+        self.assertRaises(vkontakte.VKError, limiter.call, 'token', func)
+        self.assertEqual(func.call_count, 1)
+
+
+class BatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.api = vkontakte.API(token='token', v='5.0')
+
+    def posted_code(self, post, index=0):
+        params = dict(parse_qsl(post.call_args_list[index][0][1]))
+        self.assertTrue(post.call_args_list[index][0][0].endswith('/method/execute'))
+        return params['code']
+
+    @mock.patch('vkontakte.http.post')
+    def test_batch(self, post):
+        post.return_value = 200, b'{"response":[[{"id":1}],123]}'
+        with self.api.batch() as batch:
+            users = batch.users.get(user_ids=[1], fields='sex')
+            time = batch.getServerTime()
+            self.assertFalse(users.done())
+        self.assertEqual(post.call_count, 1)
+        self.assertEqual(users.result(), [{"id": 1}])
+        self.assertEqual(time.result(), 123)
+        code = self.posted_code(post)
+        self.assertTrue(code.startswith('return [API.users.get({'), code)
+        self.assertTrue('"user_ids": "[1]"' in code, code)
+        self.assertTrue('"v": "5.0"' in code, code)
+        self.assertTrue(code.endswith('API.getServerTime({"v": "5.0"})];'), code)
+
+    @mock.patch('vkontakte.http.post')
+    def test_execute_errors(self, post):
+        post.return_value = 200, ('{"response":[false,[2],false],"execute_errors":['
+                                  '{"method":"wall.get","error_code":15,"error_msg":"Access denied"},'
+                                  '{"method":"users.get","error_code":113,"error_msg":"Invalid user id"}]}').encode('utf-8')
+        with self.api.batch() as batch:
+            wall = batch.wall.get(owner_id=1)
+            friends = batch.friends.get(user_id=1)
+            users = batch.users.get(user_ids='x')
+        self.assertEqual(friends.result(), [2])
+        for call, code in [(wall, 15), (users, 113)]:
+            try:
+                call.result()
+            except vkontakte.VKError as e:
+                self.assertEqual(e.code, code)
+            else:
+                self.fail("VKError is not raised")
+
+    @mock.patch('vkontakte.http.post')
+    def test_batch_size(self, post):
+        post.return_value = 200, b'{"response":[1,1]}'
+        batch = self.api.batch(size=2)
+        calls = [batch.getServerTime() for i in range(4)]
+        self.assertEqual(post.call_count, 2)
+        self.assertTrue(all(call.done() for call in calls))
+        batch.flush()
+        self.assertEqual(post.call_count, 2)
+
+    @mock.patch('vkontakte.http.post')
+    def test_execute_failure(self, post):
+        post.return_value = 200, b'{"error":{"error_code":13,"error_msg":"Runtime error","request_params":[]}}'
+        batch = self.api.batch()
+        call = batch.getServerTime()
+        self.assertRaises(vkontakte.VKError, batch.flush)
+        self.assertRaises(vkontakte.VKError, call.result)
+
+    @mock.patch('vkontakte.http.post')
+    def test_request_failure(self, post):
+        post.side_effect = socket.timeout()
+        batch = self.api.batch()
+        call = batch.getServerTime()
+        self.assertRaises(socket.timeout, batch.flush)
+        self.assertTrue(call.done())
+        self.assertRaises(socket.timeout, call.result)
+
+    @mock.patch('vkontakte.http.post')
+    def test_missing_results(self, post):
+        post.return_value = 200, b'{"response":[123]}'
+        with self.api.batch() as batch:
+            time = batch.getServerTime()
+            users = batch.users.get(user_ids=1)
+        self.assertEqual(time.result(), 123)
+        self.assertRaises(ValueError, users.result)
+
+    def test_not_sent(self):
+        call = self.api.batch().getServerTime()
+        self.assertRaises(RuntimeError, call.result)
+
+    def test_requires_token(self):
+        self.assertRaises(ValueError, vkontakte.API(API_ID, API_SECRET).batch)
+
+
+class PaginationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.api = vkontakte.API(token='token')
+
+    def paginate(self, _get, items, total=True):
+        def get(method, **kwargs):
+            page = items[kwargs['offset']:kwargs['offset'] + kwargs['count']]
+            return {'count': len(items), 'items': page} if total else page
+        _get.side_effect = get
+
+    @mock.patch('vkontakte.api._API._get')
+    def test_offset_pagination(self, _get):
+        self.paginate(_get, list(range(25)))
+        items = self.api.iter('groups.getMembers', group_id=1, page_size=10)
+        self.assertEqual(list(items), list(range(25)))
+        self.assertEqual(_get.call_count, 3)
+        _get.assert_called_with('groups.getMembers', group_id=1, count=10, offset=20)
+
+    @mock.patch('vkontakte.api._API._get')
+    def test_list_pagination(self, _get):
+        self.paginate(_get, list(range(20)), total=False)
+        self.assertEqual(list(self.api.iter('friends.get', page_size=10)), list(range(20)))
+        self.assertEqual(_get.call_count, 3)
+
+    @mock.patch('vkontakte.api._API._get')
+    def test_counted_list_pagination(self, _get):
+        # API versions before 5.0 return [count, item, ...]
+        items = ['a', 'b', 'c']
+        _get.side_effect = lambda method, **kwargs: (
+            [len(items)] + items[kwargs['offset']:kwargs['offset'] + kwargs['count']])
+        self.assertEqual(list(self.api.iter('wall.get', page_size=2)), items)
+        self.assertEqual(_get.call_count, 2)
+        _get.assert_called_with('wall.get', count=2, offset=2)
+
+    @mock.patch('vkontakte.api._API._get')
+    def test_counted_empty_list(self, _get):
+        _get.return_value = [0]
+        self.assertEqual(list(self.api.iter('wall.get')), [])
+
+    @mock.patch('vkontakte.api._API._get')
+    def test_limit(self, _get):
+        self.paginate(_get, list(range(100)))
+        items = self.api.iter('wall.get', page_size=10, offset=5, limit=12)
+        self.assertEqual(list(items), list(range(5, 17)))
+        self.assertEqual(_get.call_count, 2)
+
+    @mock.patch('vkontakte.api._API._get')
+    def test_prefetch(self, _get):
+        self.paginate(_get, list(range(25)))
+        items = self.api.iter('wall.get', page_size=10, prefetch=True)
+        self.assertEqual(list(items), list(range(25)))
+        self.assertEqual(_get.call_count, 3)
+
+    @mock.patch('vkontakte.api._API._get')
+    def test_cursor_pagination(self, _get):
+        _get.side_effect = [
+            {'items': [1, 2], 'next_from': 'a'},
+            {'items': [3], 'next_from': 'b'},
+            {'items': [4], 'next_from': ''},
+        ]
+        self.assertEqual(list(self.api.iter('newsfeed.get', prefetch=True)), [1, 2, 3, 4])
+        self.assertEqual(_get.call_args[1]['start_from'], 'b')
+        self.assertFalse('offset' in _get.call_args[1])
+
+    @mock.patch('vkontakte.api._API._get')
+    def test_error(self, _get):
+        _get.side_effect = [{'count': 4, 'items': [1, 2]}, vk_error(15)]
+        items = self.api.iter('wall.get', page_size=2, prefetch=True)
+        self.assertEqual(next(items), 1)
+        self.assertEqual(next(items), 2)
+        self.assertRaises(vkontakte.VKError, next, items)
+
+
+class ResponseCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = vkontakte.ResponseCache()
+        self.api = vkontakte.API(token='token', cache=self.cache)
+
+    @mock.patch('vkontakte.http.post')
+    def test_cache(self, post):
+        post.return_value = 200, b'{"response":[{"id":1}]}'
+        self.assertEqual(self.api.users.get(user_ids=[1]), [{"id": 1}])
+        self.assertEqual(self.api.users.get(user_ids=[1], timestamp=1), [{"id": 1}])
+        self.assertEqual(post.call_count, 1)
+        self.api.users.get(user_ids=[2])
+        self.assertEqual(post.call_count, 2)
+        self.assertEqual(self.cache.stats(), {'hits': 1, 'misses': 2, 'evictions': 0, 'size': 2})
+
+    @mock.patch('vkontakte.http.post')
+    def test_not_cacheable(self, post):
+        post.return_value = 200, b'{"response":1}'
+        self.api.wall.post(message='hello')
+        self.api.wall.post(message='hello')
+        self.assertEqual(post.call_count, 2)
+        self.assertRaises(ValueError, vkontakte.ResponseCache, methods={'secure.getSMSHistory': 10})
+
+    @mock.patch('vkontakte.http.post')
+    def test_errors_are_not_cached(self, post):
+        post.return_value = 200, b'{"error":{"error_code":10,"error_msg":"Internal error","request_params":[]}}'
+        self.assertRaises(vkontakte.VKError, self.api.getServerTime)
+        post.return_value = 200, b'{"response":123}'
+        self.assertEqual(self.api.getServerTime(), 123)
+
+    def test_key(self):
+        other = vkontakte.API(token='other')
+        key = self.cache.key(self.api, 'users.get', {'user_ids': 1, 'random': 5})
+        self.assertEqual(key, self.cache.key(self.api, 'users.get', {'user_ids': '1'}))
+        self.assertNotEqual(key, self.cache.key(other, 'users.get', {'user_ids': '1'}))
+
+    @mock.patch('vkontakte.cache.time')
+    def test_memory_backend(self, time):
+        time.time.return_value = 100
+        backend = vkontakte.cache.MemoryBackend(maxsize=2)
+        backend.set('a', 1, 10)
+        backend.set('b', 2, 10)
+        self.assertEqual(backend.get('a'), 1)
+        backend.set('c', 3, 10)
+        self.assertEqual((backend.get('a'), backend.get('b'), backend.get('c')), (1, None, 3))
+        self.assertEqual(backend.evictions, 1)
+        time.time.return_value = 111
+        self.assertEqual(backend.get('a', 'expired'), 'expired')
+
+    def test_file_backend(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        backend = vkontakte.cache.FileBackend(directory)
+        backend.set('a', [1], 10)
+        backend.set('b', 2, -1)
+        self.assertEqual(vkontakte.cache.FileBackend(directory).get('a'), [1])
+        self.assertEqual(backend.get('b'), None)
+        self.assertEqual(len(backend), 1)
+
+
+class BulkMapTest(unittest.TestCase):
+
+    def setUp(self):
+        self.api = vkontakte.API(token='token')
+
+    @mock.patch('vkontakte.api._API._get')
+    def test_map(self, _get):
+        _get.side_effect = lambda method, owner_id: owner_id * 10
+        results = list(self.api.map('wall.get', [{'owner_id': i} for i in range(50)], concurrency=4))
+        self.assertEqual(sorted(item.get() for item in results), [i * 10 for i in range(50)])
+        self.assertTrue(all(item.params['owner_id'] * 10 == item.result for item in results))
+
+    @mock.patch('vkontakte.api._API._get')
+    def test_ordered(self, _get):
+        import time
+
+        def get(method, owner_id):
+            time.sleep(0.001 * (owner_id % 3))
+            return owner_id
+        _get.side_effect = get
+        results = self.api.map('wall.get', ({'owner_id': i} for i in range(30)), concurrency=5, ordered=True)
+        self.assertEqual([item.result for item in results], list(range(30)))
+
+    @mock.patch('vkontakte.api._API._get')
+    def test_errors(self, _get):
+        def get(method, owner_id):
+            if owner_id == 3:
+                raise vk_error(15)
+            return owner_id
+        _get.side_effect = get
+        results = list(self.api.map('wall.get', [{'owner_id': i} for i in range(5)], ordered=True))
+        self.assertEqual([item.result for item in results], [0, 1, 2, None, 4])
+        self.assertEqual(results[3].error.code, 15)
+        self.assertRaises(vkontakte.VKError, results[3].get)
+
+    @mock.patch('vkontakte.api._API._get')
+    def test_backpressure(self, _get):
+        _get.return_value = 1
+        consumed = []
+
+        def params():
+            for i in range(1000):
+                consumed.append(i)
+                yield {'owner_id': i}
+        results = self.api.map('wall.get', params(), concurrency=2)
+        next(results)
+        self.assertTrue(len(consumed) <= 5, len(consumed))
+        results.close()
+
+    @mock.patch('vkontakte.http.post')
+    def test_shared_pool(self, post):
+        post.return_value = 200, b'{"response":1}'
+        self.api.users.get(user_ids=0)
+        post.reset_mock()
+        list(self.api.map('users.get', [{'user_ids': i} for i in range(10)], concurrency=3))
+        pools = set(id(call[1]['pool']) for call in post.call_args_list)
+        self.assertEqual(len(pools), 1)
+        self.assertTrue(self.api.pool is None)
+
+
+class PreparedCallTest(unittest.TestCase):
+
+    def posted(self, api, call):
+        with mock.patch('vkontakte.http.post') as post:
+            post.return_value = 200, b'{"response":123}'
+            self.assertEqual(call(), 123)
+        url, data = post.call_args[0][:2]
+        return url, dict(parse_qsl(data))
+
+    @mock.patch('vkontakte.api.random.randint', mock.Mock(return_value=42))
+    @mock.patch('vkontakte.api.time.time', mock.Mock(return_value=1386616969))
+    def assertSameRequest(self, api, method, constant, variable):
+        prepared = api.prepare(method, **constant)
+        self.assertEqual(
+            self.posted(api, lambda: prepared(**variable)),
+            self.posted(api, lambda: api(method=method, **dict(constant, **variable)))
+        )
+
+    def test_signed(self):
+        api = vkontakte.API(API_ID, API_SECRET, lang='ru')
+        self.assertSameRequest(api, 'users.get', {'fields': ['sex', 'bdate'], 'name_case': 'gen'},
+                               {'user_ids': u'клен', 'a': 1, 'z': {'x': 1}})
+        self.assertSameRequest(api, 'users.get', {'fields': 'sex'}, {})
+        self.assertSameRequest(api, 'users.get', {'fields': 'sex'}, {'random': 5, 'timestamp': 1})
+        self.assertSameRequest(api, 'users.get', {'fields': 'sex'}, {'fields': 'bdate', 'v': '5.0'})
+
+    def test_token(self):
+        api = vkontakte.API(token='token', v='5.0')
+        self.assertSameRequest(api, 'users.get', {'fields': 'sex'}, {'user_ids': [1, 2]})
+        self.assertSameRequest(api, 'users.get', {'fields': 'sex'}, {'v': '5.1'})
+
+    @mock.patch('vkontakte.http.post')
+    def test_timeout_and_cache(self, post):
+        post.return_value = 200, b'{"response":[{"id":1}]}'
+        api = vkontakte.API(token='token', timeout=5, cache=vkontakte.ResponseCache())
+        get_users = api.prepare('users.get', fields='sex')
+        get_users(user_ids=1)
+        get_users(user_ids=1)
+        self.assertEqual(post.call_count, 1)
+        self.assertEqual(post.call_args[0][3], 5)
+
+    @mock.patch('vkontakte.http.post')
+    def test_timeout_per_call(self, post):
+        post.return_value = 200, b'{"response":123}'
+        get_users = vkontakte.API(token='token').prepare('users.get', fields='sex')
+        get_users(user_ids=1, timeout=5, idempotent=True)
+        self.assertEqual(post.call_args[0][3], 5)
+        params = dict(parse_qsl(post.call_args[0][1]))
+        self.assertFalse('timeout' in params or 'idempotent' in params)
+        get_users(user_ids=1)
+        self.assertEqual(post.call_args[0][3], vkontakte.api.DEFAULT_TIMEOUT)
+
+
+class TokenPoolTest(unittest.TestCase):
+
+    def posted_tokens(self, post):
+        return [dict(parse_qsl(call[0][1]))['access_token'] for call in post.call_args_list]
+
+    def test_round_robin(self):
+        pool = vkontakte.TokenPool(['a', 'b', 'c'])
+        tokens = []
+        for i in range(4):
+            tokens.append(pool.acquire())
+            pool.release(tokens[-1])
+        self.assertEqual(tokens, ['a', 'b', 'c', 'a'])
+
+    def test_least_loaded(self):
+        pool = vkontakte.TokenPool(['a', 'b'], strategy='least_loaded')
+        self.assertEqual([pool.acquire(), pool.acquire(), pool.acquire()], ['a', 'b', 'a'])
+        pool.release('b')
+        self.assertEqual(pool.acquire(), 'b')
+        self.assertEqual(pool.stats()['a']['in_flight'], 2)
+
+    @mock.patch('vkontakte.tokens.time')
+    def test_quarantine(self, time):
+        time.time.return_value = 100
+        pool = vkontakte.TokenPool(['a', 'b'], cooldowns={9: 10})
+        pool.release(pool.acquire(), 9)
+        self.assertEqual([pool.acquire(), pool.acquire()], ['b', 'b'])
+        self.assertEqual(pool.stats()['a']['quarantined_for'], 10)
+        pool.release('b', 5)
+        self.assertRaises(vkontakte.tokens.NoTokensAvailable, pool.acquire)
+        time.time.return_value = 110
+        self.assertEqual(pool.acquire(), 'a')
+
+    @mock.patch('vkontakte.http.post')
+    def test_rotation_on_errors(self, post):
+        post.side_effect = [
+            (200, b'{"error":{"error_code":5,"error_msg":"User authorization failed","request_params":[]}}'),
+            (200, b'{"error":{"error_code":29,"error_msg":"Rate limit reached","request_params":[]}}'),
+            (200, b'{"response":123}'),
+        ]
+        pool = vkontakte.TokenPool(['a', 'b', 'c'])
+        api = vkontakte.API(token_pool=pool, v='5.0')
+        self.assertEqual(api.users.get(user_ids=1), 123)
+        self.assertEqual(self.posted_tokens(post), ['a', 'b', 'c'])
+        self.assertEqual(pool.stats()['b']['errors'], 1)
+        self.assertEqual(pool.acquire(), 'c')
+
+    @mock.patch('vkontakte.ratelimit.time')
+    @mock.patch('vkontakte.http.post')
+    def test_rotation_with_rate_limiter(self, post, time):
+        time.time.return_value = 100
+        post.side_effect = [
+            (200, b'{"error":{"error_code":6,"error_msg":"Too many requests per second","request_params":[]}}'),
+            (200, b'{"response":123}'),
+        ]
+        limiter = vkontakte.RateLimiter(rate=100)
+        api = vkontakte.API(token_pool=vkontakte.TokenPool(['a', 'b']), rate_limiter=limiter)
+        self.assertEqual(api.users.get(user_ids=1), 123)
+        self.assertEqual(self.posted_tokens(post), ['a', 'b'])
+        self.assertEqual(limiter.stats()['calls'], 2)
+        self.assertFalse(time.sleep.called)
+
+    @mock.patch('vkontakte.http.post')
+    def test_other_errors_are_not_rotated(self, post):
+        post.return_value = 200, b'{"error":{"error_code":15,"error_msg":"Access denied","request_params":[]}}'
+        pool = vkontakte.TokenPool(['a', 'b'])
+        api = vkontakte.API(token_pool=pool)
+        self.assertRaises(vkontakte.VKError, api.wall.get, owner_id=1)
+        self.assertEqual(post.call_count, 1)
+        self.assertEqual(pool.stats()['a']['quarantined_for'], 0)
+
+    @mock.patch('vkontakte.http.post')
+    def test_all_tokens_rejected(self, post):
+        post.return_value = 200, b'{"error":{"error_code":5,"error_msg":"User authorization failed","request_params":[]}}'
+        api = vkontakte.API(token_pool=vkontakte.TokenPool(['a', 'b']))
+        self.assertRaises(vkontakte.VKError, api.wall.get, owner_id=1)
+        self.assertEqual(post.call_count, 2)
+        self.assertRaises(vkontakte.tokens.NoTokensAvailable, api.wall.get, owner_id=1)
+
+    @mock.patch('vkontakte.http.post')
+    def test_prepared_call(self, post):
+        post.return_value = 200, b'{"response":123}'
+        api = vkontakte.API(token_pool=vkontakte.TokenPool(['a', 'b']))
+        get_users = api.prepare('users.get', fields='sex')
+        get_users(user_ids=1)
+        get_users(user_ids=2)
+        self.assertEqual(self.posted_tokens(post), ['a', 'b'])
+        self.assertTrue(post.call_args[0][0].endswith('/method/users.get'))
+
+
+class InstrumentationTest(FakeVKServerMixin, unittest.TestCase):
+
+    def setUp(self):
+        super(InstrumentationTest, self).setUp()
+        patcher = mock.patch('vkontakte.api.SECURE_API_URL', self.url.rsplit('/', 1)[0] + '/')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.instrumentation = vkontakte.Instrumentation()
+        self.metrics = vkontakte.MetricsAggregator()
+        self.instrumentation.after_request(self.metrics.record)
+        self.pool = vkontakte.ConnectionPool()
+        self.addCleanup(self.pool.clear)
+
+    def test_hooks_and_phases(self):
+        before, after = [], []
+        self.instrumentation.before_request(before.append)
+        self.instrumentation.after_request(after.append)
+        api = vkontakte.API(token='token', pool=self.pool, instrumentation=self.instrumentation)
+        self.assertEqual(api.users.get(user_ids=1), 1)
+        self.assertEqual(api.users.get(user_ids=2), 2)
+
+        self.assertEqual(before, after)
+        first, second = after
+        self.assertEqual(first.method, 'users.get')
+        self.assertEqual(first.params, {'user_ids': 1})
+        self.assertEqual(sorted(first.timings), sorted(vkontakte.instrumentation.PHASES))
+        # the second request reuses the connection
+        self.assertFalse('connect' in second.timings)
+        self.assertEqual((first.status, first.attempts, first.retries), (200, 1, 0))
+        self.assertTrue(first.bytes_sent > 0 and first.bytes_received == len(b'{"response":1}'))
+        self.assertTrue(first.duration >= sum(first.timings.values()))
+
+        stats = self.metrics.stats()['users.get']
+        self.assertEqual(stats['calls'], 2)
+        self.assertEqual(stats['phases']['wait']['count'], 2)
+        self.assertEqual(stats['phases']['connect']['count'], 1)
+        self.assertEqual(stats['errors'], {})
+
+    @mock.patch('vkontakte.ratelimit.time')
+    @mock.patch('vkontakte.http.post')
+    def test_errors_and_retries(self, post, time):
+        time.time.return_value = 100
+        post.side_effect = [
+            (200, b'{"error":{"error_code":6,"error_msg":"Too many requests per second","request_params":[]}}'),
+            (200, b'{"response":1}'),
+            (200, b'{"error":{"error_code":15,"error_msg":"Access denied","request_params":[]}}'),
+        ]
+        api = vkontakte.API(token='token', instrumentation=self.instrumentation,
+                            rate_limiter=vkontakte.RateLimiter(rate=100))
+        api.wall.get(owner_id=1)
+        self.assertRaises(vkontakte.VKError, api.wall.get, owner_id=2)
+        stats = self.metrics.stats()['wall.get']
+        self.assertEqual((stats['calls'], stats['retries']), (2, 1))
+        self.assertEqual(stats['errors'], {15: 1})
+        self.assertTrue(post.call_args[1]['trace'] is not None)
+
+    @mock.patch('vkontakte.http.post')
+    def test_cached_calls(self, post):
+        post.return_value = 200, b'{"response":[{"id":1}]}'
+        api = vkontakte.API(token='token', instrumentation=self.instrumentation,
+                            cache=vkontakte.ResponseCache())
+        api.users.get(user_ids=1)
+        api.users.get(user_ids=1)
+        stats = self.metrics.stats()['users.get']
+        self.assertEqual((stats['calls'], stats['cached']), (2, 1))
+        self.assertEqual(stats['total']['count'], 2)
+
+    def test_histogram(self):
+        histogram = vkontakte.instrumentation.Histogram()
+        for ms in (0.05, 3, 3, 4, 700):
+            histogram.add(ms / 1000.0)
+        self.assertEqual(histogram.stats()['buckets'], {0.1: 1, 5: 3, 1000: 1})
+        self.assertEqual(histogram.percentile(0.5), 5)
+        self.assertEqual(histogram.percentile(0.99), 1000)
+
+
+OK = (200, b'{"response":1}')
+
+
+@mock.patch('vkontakte.retry.time')
+@mock.patch('vkontakte.http.post')
+class RetryPolicyTest(unittest.TestCase):
+
+    def api(self, time, **options):
+        time.time.return_value = 100
+        return vkontakte.API(token='token', retry=vkontakte.RetryPolicy(**options))
+
+    def test_read_methods_are_retried(self, post, time):
+        post.side_effect = [socket.timeout(), (502, b'Bad Gateway'),
+                            (200, b'{"error":{"error_code":10,"error_msg":"Internal server error","request_params":[]}}'),
+                            OK]
+        api = self.api(time, max_attempts=4)
+        self.assertEqual(api.users.get(user_ids=1), 1)
+        self.assertEqual(post.call_count, 4)
+        self.assertEqual(time.sleep.call_count, 3)
+
+    def test_write_methods_are_not_retried(self, post, time):
+        post.side_effect = [socket.timeout(), socket.timeout(), OK]
+        api = self.api(time)
+        self.assertRaises(socket.timeout, api.wall.post, message='hi')
+        self.assertEqual(api.wall.post(message='hi', idempotent=True), 1)
+        self.assertEqual(post.call_count, 3)
+        self.assertFalse('idempotent' in dict(parse_qsl(post.call_args[0][1])))
+
+    def test_prepared_call_marked_idempotent(self, post, time):
+        post.side_effect = [socket.timeout(), OK]
+        api = self.api(time)
+        self.assertEqual(api.prepare('wall.post', idempotent=True)(message='hi'), 1)
+
+    def test_permanent_errors_are_not_retried(self, post, time):
+        post.side_effect = [(404, b'Not Found'), OK]
+        api = self.api(time)
+        self.assertRaises(vkontakte.HTTPError, api.users.get, user_ids=1)
+        self.assertEqual(post.call_count, 1)
+
+    def test_max_attempts(self, post, time):
+        post.side_effect = socket.timeout()
+        api = self.api(time, max_attempts=3)
+        self.assertRaises(socket.timeout, api.users.get, user_ids=1)
+        self.assertEqual(post.call_count, 3)
+
+    def test_deadline(self, post, time):
+        post.side_effect = socket.timeout()
+        api = self.api(time, deadline=5, backoff=10)
+        self.assertRaises(socket.timeout, api.users.get, user_ids=1, timeout=10)
+        # the socket timeout is cut down to the deadline; backoff would exceed it
+        self.assertEqual(post.call_args[0][3], 5)
+        self.assertEqual(post.call_count, 1)
+        self.assertFalse(time.sleep.called)
+
+    @mock.patch('vkontakte.ratelimit.random.uniform', mock.Mock(return_value=0))
+    def test_backoff(self, post, time):
+        policy = vkontakte.RetryPolicy(backoff=1, max_backoff=4)
+        self.assertEqual([policy.backoff_delay(i) for i in range(4)], [0.5, 1, 2, 2])
+
+    @mock.patch('vkontakte.ratelimit.time')
+    def test_rate_limiter_retries_error_6(self, ratelimit_time, post, time):
+        ratelimit_time.time.return_value = 100
+        post.return_value = (200, b'{"error":{"error_code":6,"error_msg":"Too many requests per second","request_params":[]}}')
+        api = self.api(time, max_attempts=3)
+        api.rate_limiter = vkontakte.RateLimiter(rate=100, max_retries=2)
+        self.assertRaises(vkontakte.VKError, api.users.get, user_ids=1)
+        self.assertEqual(post.call_count, 3)
+
+    def test_is_idempotent(self, post, time):
+        policy = vkontakte.RetryPolicy(idempotent_methods=['execute'])
+        self.assertEqual([policy.is_idempotent(method) for method in (
+            'users.get', 'groups.isMember', 'getServerTime', 'execute', 'wall.post', 'likes.add')],
+            [True, True, True, True, False, False])
+
+    def test_circuit_breaker(self, post, time):
+        post.side_effect = [socket.timeout(), (500, b''), OK, OK]
+        breaker = vkontakte.CircuitBreaker(failure_threshold=2, reset_timeout=30)
+        api = self.api(time, max_attempts=1, circuit_breaker=breaker)
+        self.assertRaises(socket.timeout, api.users.get, user_ids=1)
+        self.assertRaises(vkontakte.HTTPError, api.users.get, user_ids=1)
+        self.assertTrue(breaker.is_open)
+        self.assertRaises(vkontakte.CircuitOpenError, api.users.get, user_ids=1)
+        self.assertEqual(post.call_count, 2)
+
+        time.time.return_value = 131
+        self.assertEqual(api.users.get(user_ids=1), 1)
+        self.assertFalse(breaker.is_open)
+        self.assertEqual(api.users.get(user_ids=1), 1)
+
+    def test_failed_probe_reopens_circuit(self, post, time):
+        post.side_effect = socket.timeout()
+        breaker = vkontakte.CircuitBreaker(failure_threshold=1, reset_timeout=30)
+        api = self.api(time, max_attempts=1, circuit_breaker=breaker)
+        self.assertRaises(socket.timeout, api.users.get, user_ids=1)
+        time.time.return_value = 131
+        self.assertRaises(socket.timeout, api.users.get, user_ids=1)
+        self.assertRaises(vkontakte.CircuitOpenError, api.users.get, user_ids=1)
+
+    def test_throttling_does_not_open_circuit(self, post, time):
+        post.return_value = (200, b'{"error":{"error_code":6,"error_msg":"Too many requests per second","request_params":[]}}')
+        breaker = vkontakte.CircuitBreaker(failure_threshold=1)
+        api = self.api(time, max_attempts=2, circuit_breaker=breaker)
+        self.assertRaises(vkontakte.VKError, api.users.get, user_ids=1)
+        self.assertEqual(post.call_count, 2)
+        self.assertFalse(breaker.is_open)
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,142 @@
+# coding: utf-8
+"""
+Spreading requests over several access tokens.
+
+    >>> pool = TokenPool(['token1', 'token2', 'token3'], strategy='least_loaded')
+    >>> vk = API(token_pool=pool)
+    >>> vk.users.get(user_ids=1)
+
+Each request uses a token chosen by ``strategy``. When a request fails
+with an auth error (5) or a rate limit error (6, 9, 29), its token is
+quarantined for a cooldown period and the request is repeated with
+another token. A RateLimiter of the API keeps a bucket per token but
+leaves error 6 to the pool instead of retrying it with the same token.
+"""
+from __future__ import with_statement
+import threading
+import time
+
+from vkontakte.api import VKError
+
+# error code -> quarantine period, seconds
+DEFAULT_COOLDOWNS = {
+    5: 3600,   # user authorization failed
+    6: 1,      # too many requests per second
+    9: 60,     # flood control
+    29: 3600,  # rate limit reached
+}
+
+STRATEGIES = ('round_robin', 'least_loaded')
+
+
+class NoTokensAvailable(Exception):
+    """ All tokens of the pool are quarantined. """
+
+
+class _TokenState(object):
+    __slots__ = ['token', 'calls', 'errors', 'in_flight', 'quarantined_until', 'last_used']
+
+    def __init__(self, token):
+        self.token = token
+        self.calls = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.quarantined_until = 0
+        self.last_used = 0
+
+
+class TokenPool(object):
+    """
+    Thread-safe pool of access tokens.
+
+    ``strategy`` is 'round_robin' or 'least_loaded' (token with the
+    fewest requests in progress); ``cooldowns`` overrides quarantine
+    periods of DEFAULT_COOLDOWNS.
+    """
+
+    def __init__(self, tokens, strategy='round_robin', cooldowns=None):
+        if not tokens:
+            raise ValueError("At least one token is required")
+        if strategy not in STRATEGIES:
+            raise ValueError("Unknown strategy: %s" % strategy)
+        self.strategy = strategy
+        self.cooldowns = dict(DEFAULT_COOLDOWNS)
+        if cooldowns:
+            self.cooldowns.update(cooldowns)
+        self._states = [_TokenState(token) for token in tokens]
+        self._index = dict((state.token, state) for state in self._states)
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._states)
+
+    def acquire(self):
+        """ Choose a token for a request. """
+        now = time.time()
+        with self._lock:
+            healthy = [state for state in self._states if state.quarantined_until <= now]
+            if not healthy:
+                wait = min(state.quarantined_until for state in self._states) - now
+                raise NoTokensAvailable("All tokens are quarantined for at least %.1f s" % wait)
+
+            if self.strategy == 'least_loaded':
+                state = min(healthy, key=lambda state: (state.in_flight, state.last_used))
+            else:
+                count = len(self._states)
+                for offset in range(count):
+                    state = self._states[(self._next + offset) % count]
+                    if state.quarantined_until <= now:
+                        self._next = (self._next + offset + 1) % count
+                        break
+
+            state.calls += 1
+            state.in_flight += 1
+            state.last_used = now
+            return state.token
+
+    def release(self, token, error_code=None):
+        """
+        Return the token after a request; quarantine it
+        if the request failed with ``error_code`` from cooldowns.
+        """
+        with self._lock:
+            state = self._index[token]
+            state.in_flight -= 1
+            if error_code is not None:
+                state.errors += 1
+                if error_code in self.cooldowns:
+                    state.quarantined_until = time.time() + self.cooldowns[error_code]
+
+    def call(self, func, *args):
+        """
+        Call ``func(token, *args)``; repeat the call with another token
+        if the token is rejected, trying every token at most once.
+        """
+        for i in range(len(self._states)):
+            token = self.acquire()
+            try:
+                result = func(token, *args)
+            except VKError as e:
+                self.release(token, e.code)
+                if e.code not in self.cooldowns:
+                    raise
+                error = e
+                continue
+            except Exception:
+                self.release(token)
+                raise
+            self.release(token)
+            return result
+        raise error
+
+    def stats(self):
+        """ Health of tokens: {token: {calls, errors, in_flight, quarantined_for}} """
+        now = time.time()
+        with self._lock:
+            return dict((state.token, {
+                'calls': state.calls,
+                'errors': state.errors,
+                'in_flight': state.in_flight,
+                'quarantined_for': max(0, state.quarantined_until - now),
+            }) for state in self._states)